@@ -1,10 +1,12 @@
-import copy
 import csv
+import hashlib
+import heapq
 from datetime import datetime, timedelta
 from dateutil import tz
-from collections import defaultdict
+from collections import defaultdict, deque
 from dataclasses import dataclass, field
 from functools import reduce
+from itertools import groupby, islice, repeat
 from typing import Dict
 
 from sortedcontainers import SortedSet
@@ -15,6 +17,14 @@ from . import utils
 
 # See also http://lightonphiri.org/blog/quantifying-my-phone-usage-android-applications-usage-statistics
 
+# The UsageHistory app sometimes duplicates an event ~2 seconds after the
+# original, so events this close after an identical one are dropped.
+DUPLICATE_WINDOW = timedelta(seconds=4)
+# Minutes between app usages that split them into separate phone checks, and
+# between checks that split them into separate events.
+CHECK_GAP_MINS = 0.01
+EVENT_GAP_MINS = 20
+
 
 @dataclass
 class PhoneSession:
@@ -31,6 +41,15 @@ class PhoneSession:
     def get_duration(self):
         return self.end_time - self.start_time
 
+    def add(self, other):
+        """Extends this session to the end of other, which follows it, and adds
+        in its usages and checks.
+        """
+        self.end_time = other.end_time
+        for app, duration in other.summed_usages.items():
+            self.summed_usages[app] += duration
+        self.checks += other.checks
+
     def to_calendar_event(self):
         used_time = reduce(lambda t1, t2: t1 + t2,
                            self.summed_usages.values(),
@@ -78,59 +97,184 @@ class PhoneSession:
         )
 
 
+class RecentUsages(object):
+    """Sliding window over the last few seconds of app usages, used to find
+    duplicated events.  Usages should be added in order of start time.
+    """
+
+    def __init__(self, window=DUPLICATE_WINDOW):
+        self.window = window
+        # (start time, (app, duration)) of each usage, in the order added.
+        self._usages = deque()
+
+    def add(self, start_time, app, duration):
+        """Adds the usage unless it duplicates a recent one, and returns
+        whether it was added.
+        """
+        # Start times are made unique by moving them at most a second earlier,
+        # so once a usage is this far behind, the one before it can't be
+        # reached again.
+        while (len(self._usages) > 1 and start_time - self._usages[1][0]
+               > self.window + timedelta(seconds=1)):
+            self._usages.popleft()
+        key = (app, duration)
+        # The first usage more than window before this one is still checked.
+        for usage_start, usage_key in reversed(self._usages):
+            if usage_key == key:
+                return False
+            if start_time - usage_start > self.window:
+                break
+        self._usages.append((start_time, key))
+        return True
+
+
 def get_app_usages_from_usage_history_app_export_lines(csv_lines):
     """Parses export data from
     https://play.google.com/store/apps/details?id=com.huybn.UsageHistory
+
+    csv_lines should be a list of the lines of one or more concatenated
+    exports, each sorted by time.  The exports are split at their header lines
+    and merged like iter_app_usages_from_usage_history_app_exports does, so
+    rows repeated across overlapping exports are dropped without keeping every
+    row seen.
     """
-    reader = csv.DictReader(csv_lines)
-    # Convert times to datetime and get rid of non-data lines.  Also skip
-    # repeated lines.
-    parsed_rows = set()
-    app_usages = []
-    # i = 0
-    for row in reader:
-        # i += 1
-        # if i > 10:
-        #     raise Exception()
+    return list(iter_app_usages_from_usage_history_app_exports(
+        _split_concatenated_exports(csv_lines)))
+
+
+class _ExportLines(object):
+    """The rows of one export within concatenated csv lines, decoded each time
+    they are iterated over.
+    """
+
+    def __init__(self, csv_lines, start, end):
+        self._csv_lines = csv_lines
+        self._start = start
+        self._end = end
+
+    def __iter__(self):
+        return csv.DictReader(
+            islice(self._csv_lines, self._start, self._end))
+
+
+def _split_concatenated_exports(csv_lines):
+    if not csv_lines:
+        return []
+    header = csv_lines[0].rstrip('\r\n')
+    # Header lines from concatenating multiple csvs start the next export.
+    starts = [i for i, line in enumerate(csv_lines)
+              if line.rstrip('\r\n') == header]
+    return [_ExportLines(csv_lines, start, end)
+            for start, end in zip(starts, starts[1:] + [len(csv_lines)])]
+
+
+def iter_app_usages_from_usage_history_app_exports(exports):
+    """Yields the app usages from several UsageHistory exports in order of
+    start time.
+
+    exports should be an iterable of each export's rows as dicts, which can be
+    iterated over twice (e.g. drive_api.SpreadsheetRows), and are sorted by
+    time.  The exports are merged a row at a time, and ones with the same
+    content as an earlier export are skipped.
+    """
+    seen_digests = set()
+    export_rows = []
+    for rows in exports:
+        digest = hashlib.sha256()
+        for row in rows:
+            digest.update(repr(tuple(row.values())).encode())
+        if digest.digest() in seen_digests:
+            print(f'Skipping repeated export {getattr(rows, "name", "")}')
+            continue
+        seen_digests.add(digest.digest())
+        export_rows.append(_iter_usage_history_rows(rows))
+    # Rows that overlapping exports share end up next to each other, and are
+    # dropped as duplicates.
+    app_usages = _iter_usage_history_app_usages(
+        _merge_usage_history_rows(export_rows))
+    # Start times are moved at most a second earlier, so usages only need to
+    # be held back that long to sort them.
+    held_usages = []
+    for i, usage in enumerate(app_usages):
+        while (held_usages and held_usages[0][0]
+               < usage.start_time - timedelta(seconds=1)):
+            yield heapq.heappop(held_usages)[2]
+        heapq.heappush(held_usages, (usage.start_time, i, usage))
+    while held_usages:
+        yield heapq.heappop(held_usages)[2]
+
+
+def _merge_usage_history_rows(export_rows):
+    """Merges rows from several exports' _iter_usage_history_rows in order of
+    time.
+
+    An overlapping export can start or end partway through the rows at a time,
+    so rows at the same time are put in the order of the export with the most
+    of them, followed by any others.
+    """
+    merged = heapq.merge(*[zip(rows, repeat(i))
+                           for i, rows in enumerate(export_rows)],
+                         key=lambda row_and_export: row_and_export[0][0])
+    for _, same_time in groupby(
+            merged, key=lambda row_and_export: row_and_export[0][0]):
+        # Merging is stable, so each export's rows at a time stay together.
+        export_groups = [[row for row, _ in group] for _, group in groupby(
+            same_time, key=lambda row_and_export: row_and_export[1])]
+        export_groups.sort(key=len, reverse=True)
+        for rows in export_groups:
+            yield from rows
+
+
+def _iter_usage_history_rows(rows):
+    """Yields (time in ms, app name, duration, row values) for each data row
+    of a UsageHistory export.
+    """
+    for row in rows:
         # Ignore header lines from concatenating multiple csvs
         if list(row.keys()) == list(row.values()):
             continue
+        yield (int(row['Time in ms']), row['\ufeff\"App name\"'],
+               timedelta(seconds=float(row['Duration (s)'])),
+               tuple(row.values()))
+
+
+def _iter_usage_history_app_usages(rows):
+    """Yields an app usage for each row from _iter_usage_history_rows,
+    skipping duplicates.  Rows should be in order of time.
+    """
+    # Looking up 'PST' is slow, so only do it once.
+    pst = tz.gettz('PST')
+    recent_usages = RecentUsages()
+    last_use_time = None
+    # Repeated rows have the same time, so only the rows at the latest time
+    # are needed to skip them.
+    latest_time_ms = None
+    latest_rows = set()
+    for time_ms, app, duration, row_values in rows:
+        if time_ms != latest_time_ms:
+            latest_time_ms = time_ms
+            latest_rows.clear()
         # Ignore duplicate rows.
-        row_tuple = tuple(row.values())
-        if row_tuple in parsed_rows:
+        if row_values in latest_rows:
             continue
-        parsed_rows.add(row_tuple)
+        latest_rows.add(row_values)
         # Get time from row data.
-        use_time = datetime.fromtimestamp(
-            int(row['Time in ms']) / 1000).replace(tzinfo=tz.gettz('PST'))
+        use_time = datetime.fromtimestamp(time_ms / 1000).replace(tzinfo=pst)
         # Make sure that all times are unique, so in sorting nothing gets
         # rearranged.  This PROBABLY keeps the initial order, but might still
         # be a bit buggy.
-        if app_usages and use_time == app_usages[-1].start_time:
+        if use_time == last_use_time:
             use_time -= timedelta(seconds=1)
-        duration = timedelta(seconds=float(row['Duration (s)']))
+        # Skip the usage_history app's duplicated events.
+        if not recent_usages.add(use_time, app, duration):
+            continue
         cur_usage = PhoneSession(
             start_time=use_time,
             end_time=use_time + duration,
         )
-        cur_usage.summed_usages[row['\ufeff\"App name\"']] += duration
-        # There is a bug with the usage_history app where events are sometimes
-        # duplicated ~2 seconds after the original event.  This attempts to
-        # filter those duplicates out of the final data set.
-        duplicate = False
-        for existing_usage in app_usages[::-1]:
-            if existing_usage.summed_usages == cur_usage.summed_usages:
-                duplicate = True
-            if ((cur_usage.start_time - existing_usage.start_time)
-                    > timedelta(seconds=4)):
-                break
-        if not duplicate:
-            # print(cur_usage.start_time)
-            # for k, v in cur_usage.summed_usages.items():
-            #     print(k, v)
-            app_usages.append(cur_usage)
-    app_usages.sort(key=lambda usage: usage.start_time)
-    return app_usages
+        cur_usage.summed_usages[app] += duration
+        last_use_time = use_time
+        yield cur_usage
 
 
 def get_app_usages_from_phone_time_app_export_lines(csv_lines):
@@ -180,43 +324,53 @@ def get_app_usages_from_phone_time_app_export_lines(csv_lines):
 
 
 def unify_sessions(sessions):
-    def join_summed_usages(su1, su2):
-        new = copy.deepcopy(su1)
-        for app, duration in su2.items():
-            new[app] += duration
-        return new
-    unified = PhoneSession(
-        start_time=sessions[0].start_time,
-        end_time=sessions[-1].end_time,
-        summed_usages=reduce(join_summed_usages,
-                             [s.summed_usages for s in sessions]),
-        checks=sum([s.checks for s in sessions]),
-    )
-    # try:
-    #     unified.to_calendar_event()
-    # except:
-    #     for s in sessions:
-    #         print(s.start_time.strftime('%M %S'))
-    #         for k, v in s.summed_usages.items():
-    #             print(k, utils.strfdelta(v))
-    #     print(unified.to_calendar_event())
+    unified = PhoneSession(start_time=sessions[0].start_time, checks=0)
+    for s in sessions:
+        unified.add(s)
     return unified
 
 
+def collapse_sessions(sessions, idle_mins=20):
+    """Yields the sessions merged wherever the gap between them is no more
+    than idle_mins.  sessions should be sorted, and may be any iterable.
+    """
+    threshold = timedelta(minutes=idle_mins)
+    merged = None
+    for s in sessions:
+        if merged is not None and s.start_time - merged.end_time > threshold:
+            yield merged
+            merged = None
+        if merged is None:
+            merged = PhoneSession(start_time=s.start_time, checks=0)
+        merged.add(s)
+    if merged is not None:
+        yield merged
+
+
 def collapse_all_sessions(sessions, idle_mins=20):
-    return [unify_sessions(s) for s in utils.split_on_gaps(
-        sessions, timedelta(minutes=idle_mins),
-        key=lambda s: s.start_time, last_key=lambda s: s.end_time)]
+    return list(collapse_sessions(sessions, idle_mins))
 
 
 def create_events(csv_lines):
-    app_usages = get_app_usages_from_usage_history_app_export_lines(csv_lines)
+    return create_events_from_app_usages(
+        get_app_usages_from_usage_history_app_export_lines(csv_lines))
+
+
+def create_events_from_exports(exports):
+    """Like create_events, but for several UsageHistory exports (see
+    iter_app_usages_from_usage_history_app_exports).
+    """
+    return create_events_from_app_usages(
+        iter_app_usages_from_usage_history_app_exports(exports))
+
+
+def create_events_from_app_usages(app_usages):
     # Group individual app usages into continuous usage sessions.
-    sessions = collapse_all_sessions(app_usages, idle_mins=0.01)
+    sessions = collapse_sessions(app_usages, idle_mins=CHECK_GAP_MINS)
     # Each session should count as a single phone "check".
-    for s in sessions:
-        s.checks = 1
+    checks = (PhoneSession(s.start_time, s.end_time, s.summed_usages, checks=1)
+              for s in sessions)
     # Create new sessions representing multiple sessions happening quickly
     # after each other.
-    grouped_sessions = collapse_all_sessions(sessions, idle_mins=20)
+    grouped_sessions = collapse_sessions(checks, idle_mins=EVENT_GAP_MINS)
     return [ps.to_calendar_event() for ps in grouped_sessions]
@@ -1,10 +1,21 @@
+import hashlib
+import json
+import math
+import os
 import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from concurrent.futures import as_completed
 from typing import List, Iterable, Tuple
-from datetime import datetime
+from datetime import datetime, timedelta
 from googleapiclient.discovery import build
-from pprint import pprint, pformat
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+import httplib2
+from pprint import pprint
 
-from . import utils
+from . import event_mirror
+from . import request_executor
 
 # https://developers.google.com/calendar/v3/reference/events
 CalendarEvent = dict
@@ -22,6 +33,13 @@ def print_event(e: CalendarEvent) -> str:
 
 EVENT_DESCRIPTION_LENGTH_LIMIT = 8100  # characters
 
+# The calendar api accepts up to 1000 requests in a batch, but starts rate
+# limiting individual requests well before that.
+BATCH_SIZE = 50
+BATCH_RETRIES = 5
+# Largest page size the events list api allows.
+EVENTS_PAGE_SIZE = 2500
+
 
 def get_consistant_event_timing(event: CalendarEvent) -> Tuple[str, str]:
   """Get start/end time strings that are consistant from a given event.
@@ -29,13 +47,22 @@ def get_consistant_event_timing(event: CalendarEvent) -> Tuple[str, str]:
     Seconds can be rounded strangely by Google calendar, so we only compare up
     to the minute.
     """
-  return (event['start']['dateTime'][:16], event['end']['dateTime'][:16])
+  # All day events only have a date.
+  return tuple(event[k].get('dateTime', event[k].get('date'))[:16]
+               for k in ('start', 'end'))
 
 
-def unique_event_key(event: CalendarEvent) -> str:
-  """Returns a string that should uniquely identify an event."""
-  return '|'.join((event.get('description', ''),)
-                  + get_consistant_event_timing(event))
+def event_fingerprint(event: CalendarEvent) -> bytes:
+  """Returns a compact hash of an event's summary, description and timing.
+
+  Timing is compared in UTC to the minute, like get_consistant_event_timing.
+  """
+  timing = [
+      event_mirror.get_event_time_utc(event[k]).strftime('%Y-%m-%dT%H:%M')
+      for k in ('start', 'end')]
+  content = '\x1f'.join(
+      [event.get('summary', ''), event.get('description', '')] + timing)
+  return hashlib.blake2b(content.encode(), digest_size=16).digest()
 
 
 def time_started_event_key(event: CalendarEvent) -> str:
@@ -43,40 +70,313 @@ def time_started_event_key(event: CalendarEvent) -> str:
   return get_consistant_event_timing(event)[0]
 
 
+def get_changed_fields(existing: CalendarEvent,
+                       desired: CalendarEvent) -> dict:
+  """Returns the fields of desired that differ from existing."""
+  changed = {}
+  existing_timing = get_consistant_event_timing(existing)
+  desired_timing = get_consistant_event_timing(desired)
+  for i, time_field in enumerate(('start', 'end')):
+    if existing_timing[i] != desired_timing[i]:
+      changed[time_field] = desired[time_field]
+  for text_field in ('summary', 'description'):
+    if existing.get(text_field, '') != desired.get(text_field, ''):
+      changed[text_field] = desired.get(text_field, '')
+  return changed
+
+
+@dataclass
+class ReconciliationPlan:
+  """Writes needed to make a calendar hold a set of desired events."""
+  inserts: List[CalendarEvent] = field(default_factory=list)
+  # Pairs of (existing event, fields of it to change).
+  patches: List[Tuple[CalendarEvent, dict]] = field(default_factory=list)
+  deletes: List[CalendarEvent] = field(default_factory=list)
+  num_unchanged: int = 0
+
+  def get_num_api_calls(self) -> int:
+    return len(self.inserts) + len(self.patches) + len(self.deletes)
+
+  def get_num_http_requests(self) -> int:
+    return sum(math.ceil(len(writes) / BATCH_SIZE)
+               for writes in (self.inserts, self.patches, self.deletes))
+
+  def summarize(self) -> str:
+    return (f'{len(self.inserts)} inserts, {len(self.patches)} patches, '
+            f'{len(self.deletes)} deletes, {self.num_unchanged} unchanged '
+            f'({self.get_num_api_calls()} api calls in '
+            f'{self.get_num_http_requests()} batched requests)')
+
+  def print_writes(self):
+    for e in self.inserts:
+      print('INSERT ', end='')
+      print_event(e)
+    for e, changed in self.patches:
+      print(f'PATCH {", ".join(changed)} of ', end='')
+      print_event(e)
+    for e in self.deletes:
+      print('DELETE ', end='')
+      print_event(e)
+
+
+def plan_reconciliation(
+    desired_events: Iterable[CalendarEvent],
+    existing_events: Iterable[CalendarEvent]) -> ReconciliationPlan:
+  """Plans the fewest writes that make existing_events match desired_events.
+
+  Events are matched up by the minute they start at.  Matched existing events
+  are patched with only the fields that differ, unmatched desired events are
+  inserted, and extra existing events starting at the same minute as a desired
+  event are deleted.  Existing events that share no start minute with a desired
+  event are left alone.
+  """
+  existing_by_start = defaultdict(list)
+  for e in existing_events:
+    existing_by_start[time_started_event_key(e)].append(e)
+  existing_fingerprints = {}
+  plan = ReconciliationPlan()
+  desired_starts = set()
+  for desired in desired_events:
+    start_key = time_started_event_key(desired)
+    desired_starts.add(start_key)
+    candidates = existing_by_start[start_key]
+    if not candidates:
+      plan.inserts.append(desired)
+      continue
+    # Prefer an existing event that needs no changes at all.
+    fingerprint = event_fingerprint(desired)
+    for i, e in enumerate(candidates):
+      if e['id'] not in existing_fingerprints:
+        existing_fingerprints[e['id']] = event_fingerprint(e)
+      if existing_fingerprints[e['id']] == fingerprint:
+        candidates.pop(i)
+        plan.num_unchanged += 1
+        break
+    else:
+      changes = [get_changed_fields(e, desired) for e in candidates]
+      best = min(range(len(candidates)), key=lambda i: len(changes[i]))
+      existing = candidates.pop(best)
+      if changes[best]:
+        plan.patches.append((existing, changes[best]))
+      else:
+        plan.num_unchanged += 1
+  for start_key in desired_starts:
+    plan.deletes += existing_by_start[start_key]
+  return plan
+
+
 class CalendarApi(object):
 
-  def __init__(self, creds):
-    self.service = build('calendar', 'v3', credentials=creds)
+  def __init__(self, creds, api_endpoint=None, sync_cache_dir=None,
+               executor=None, calendar_list_cache_path=None,
+               calendar_list_cache_ttl=timedelta(days=1)):
+    """If api_endpoint is given, requests are sent there instead of to Google
+    (e.g. to a fake_google_api server) without any credentials.
+
+    All requests are sent through executor, which should be shared with the
+    other api wrappers.
+
+    If sync_cache_dir is given, a local SQLite mirror of each calendar read
+    with get_events, and of every event written, is kept there.  Later calls
+    then only need to fetch the changes made since, and existing events are
+    looked up locally.
 
-  def get_events(self, calendar_id: str) -> List[CalendarEvent]:
+    The calendar list is kept in memory once fetched, and also in
+    calendar_list_cache_path for up to calendar_list_cache_ttl if given.
+    """
+    self.mirror = None
+    if sync_cache_dir:
+      os.makedirs(sync_cache_dir, exist_ok=True)
+      self.mirror = event_mirror.EventMirror(
+          os.path.join(sync_cache_dir, 'events.sqlite'), event_fingerprint)
+    self.calendar_list_cache_path = calendar_list_cache_path
+    self.calendar_list_cache_ttl = calendar_list_cache_ttl
+    self._calendars = None
+    self.executor = executor or request_executor.RequestExecutor(creds)
+    if api_endpoint:
+      self.service = build('calendar', 'v3', http=httplib2.Http(),
+                           client_options=dict(api_endpoint=api_endpoint))
+      self.batch_uri = api_endpoint + 'batch/calendar/v3'
+    else:
+      self.service = build('calendar', 'v3', credentials=creds)
+      self.batch_uri = 'https://www.googleapis.com/batch/calendar/v3'
+
+  def execute_batched(self, requests, description='requests',
+                      ignored_statuses=()) -> list:
+    """Executes requests in multi-part batches.
+
+    Sub-requests that fail with a retryable status are retried in later
+    batches; any other failure is raised.  Failures with a status in
+    ignored_statuses are treated as successes with a None response.  Returns
+    the responses in the same order as the requests.
+    """
+    if not requests:
+      return []
+    responses = [None] * len(requests)
+    pending = list(range(len(requests)))
+    start_time = time.time()
+    for attempt in range(BATCH_RETRIES):
+      failures = {}
+
+      def callback(request_id, response, exception):
+        if exception is None:
+          responses[int(request_id)] = response
+        elif exception.resp.status not in ignored_statuses:
+          failures[int(request_id)] = exception
+
+      futures = []
+      for batch_start in range(0, len(pending), BATCH_SIZE):
+        batch = BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+        batch_ids = pending[batch_start:batch_start + BATCH_SIZE]
+        for i in batch_ids:
+          batch.add(requests[i], request_id=str(i))
+        futures.append(
+            self.executor.submit(batch, 'calendar', cost=len(batch_ids)))
+      for num_done, future in enumerate(as_completed(futures)):
+        future.result()
+        print(f'{len(requests) - len(pending) + num_done * BATCH_SIZE} / '
+              f'{len(requests)} {description}', end='\r')
+      for i, e in failures.items():
+        if not request_executor.is_retryable(e):
+          print(f'FAILED request {requests[i].method} {requests[i].uri} '
+                f'{requests[i].body}')
+          raise e
+      pending = sorted(failures)
+      if not pending:
+        break
+      self.executor.record_retries(len(pending))
+      sleep_secs = self.executor.backoff_secs(attempt)
+      print(f'{len(pending)} {description} failed, retrying them in '
+            f'{sleep_secs:.1f}s...')
+      time.sleep(sleep_secs)
+    else:
+      raise failures[pending[0]]
+    elapsed_secs = max(time.time() - start_time, 1e-6)
+    print(f'Finished {len(requests)} {description} in {elapsed_secs:.1f}s '
+          f'({len(requests) / elapsed_secs:.1f} events/s)')
+    return responses
+
+  def get_events(self, calendar_id: str, start_datetime: datetime = None,
+                 end_datetime: datetime = None) -> List[CalendarEvent]:
+    """Gets events that start at or after start_datetime and end at or
+    before end_datetime (see filter_events).
+
+    Without a mirror, the time window is sent to the server so that only
+    events overlapping it are downloaded.
+    """
+    if self.mirror:
+      # Sync tokens cannot be combined with time bounds, so sync everything
+      # and query the mirror instead.
+      self._sync_events(calendar_id)
+      return self.mirror.get_events(calendar_id, start_datetime, end_datetime)
+    list_args = {}
+    if start_datetime is not None:
+      list_args['timeMin'] = start_datetime.astimezone().isoformat()
+    if end_datetime is not None:
+      list_args['timeMax'] = end_datetime.astimezone().isoformat()
+    return filter_events(self._list_events(calendar_id, **list_args)[0],
+                         start_datetime, end_datetime)
+
+  def _list_events(self, calendar_id: str,
+                   **list_args) -> Tuple[List[CalendarEvent], str]:
+    """Returns all events matching list_args and the sync token for them."""
     page_token = None
     events = []
     while page_token != '':
-      response = utils.retry_on_error(
+      response = self.executor.execute(
           self.service.events().list(calendarId=calendar_id,
-                                     pageToken=page_token).execute)
+                                     pageToken=page_token,
+                                     maxResults=EVENTS_PAGE_SIZE,
+                                     **list_args), 'calendar')
       events += response.get('items', [])
       page_token = response.get('nextPageToken', '')
-    return events
+    return events, response.get('nextSyncToken')
+
+  def _sync_events(self, calendar_id: str):
+    """Updates the mirror with the calendar's changes since the last sync.
+
+    See https://developers.google.com/calendar/api/guides/sync.
+    """
+    sync_token = self.mirror.get_sync_token(calendar_id)
+    if sync_token:
+      try:
+        changes, sync_token = self._list_events(calendar_id,
+                                                syncToken=sync_token)
+      except HttpError as e:
+        # The server expires sync tokens after a while.
+        if e.resp.status != 410:
+          raise
+        print(f'Sync token for {calendar_id} expired, resyncing...')
+        sync_token = None
+      else:
+        self.mirror.apply_changes(calendar_id, changes, sync_token)
+    if not sync_token:
+      changes, sync_token = self._list_events(calendar_id)
+      self.mirror.apply_changes(calendar_id, changes, sync_token,
+                                full_sync=True)
+    print(f'Synced {len(changes)} changed events from {calendar_id}.')
 
-  def list_calendars(self) -> List[CalendarList]:
+  def reconcile_mirror(self, calendar_name: str):
+    """Repairs drift between the mirror and the calendar by re-downloading
+    the whole calendar.
+    """
+    if self.mirror is None:
+      raise ValueError('There is no mirror to reconcile without a '
+                       'sync_cache_dir.')
+    calendar_id = self.get_calendar_id(calendar_name)
+    mirrored = {e['id']: e for e in self.mirror.get_events(calendar_id)}
+    events, sync_token = self._list_events(calendar_id)
+    num_missing = len([e for e in events if e['id'] not in mirrored])
+    num_stale = len([e for e in events
+                     if e['id'] in mirrored and e != mirrored[e['id']]])
+    num_extra = len(mirrored.keys() - {e['id'] for e in events})
+    print(f'Mirror of {calendar_name} was missing {num_missing} events, had '
+          f'{num_stale} stale events and {num_extra} extra events.')
+    self.mirror.apply_changes(calendar_id, events, sync_token, full_sync=True)
+
+  def list_calendars(self, refresh: bool = False) -> List[CalendarList]:
+    """Lists calendars, using the cached list unless refresh is True."""
+    if not refresh:
+      if self._calendars is None:
+        self._calendars = self._read_calendar_list_cache()
+      if self._calendars is not None:
+        return self._calendars
     calendars = []
     page_token = None
     while page_token != '':
       page_token = '' if not page_token else page_token
-      calendar_list = utils.retry_on_error(
-          self.service.calendarList().list(pageToken=page_token).execute)
+      calendar_list = self.executor.execute(
+          self.service.calendarList().list(pageToken=page_token), 'calendar')
       calendars += calendar_list['items']
       page_token = calendar_list.get('nextPageToken', '')
+    self._calendars = calendars
+    if self.calendar_list_cache_path:
+      os.makedirs(os.path.dirname(self.calendar_list_cache_path) or '.',
+                  exist_ok=True)
+      with open(self.calendar_list_cache_path, 'w') as f:
+        json.dump(calendars, f)
     return calendars
 
+  def _read_calendar_list_cache(self) -> List[CalendarList]:
+    """Returns the calendar list on disk, or None if it is missing or stale."""
+    path = self.calendar_list_cache_path
+    if not path or not os.path.exists(path):
+      return None
+    age = timedelta(seconds=time.time() - os.path.getmtime(path))
+    if age > self.calendar_list_cache_ttl:
+      return None
+    with open(path, 'r') as f:
+      return json.load(f)
+
   def get_calendar_id(self, calendar_name: str) -> str:
-    matches = [
-        cal['id']
-        for cal in self.list_calendars()
-        if cal['summary'] == calendar_name
-    ]
-    assert len(matches) == 1
+    def find_matches(calendars):
+      return [cal['id'] for cal in calendars
+              if cal['summary'] == calendar_name]
+    matches = find_matches(self.list_calendars())
+    if len(matches) != 1:
+      # The cached list may predate the calendar being added or renamed.
+      matches = find_matches(self.list_calendars(refresh=True))
+    assert len(matches) == 1, (calendar_name, matches)
     return matches[0]
 
   def clear_calendar(self,
@@ -84,19 +384,13 @@ class CalendarApi(object):
                      dry_run: bool = False,
                      **filter_args):
     calendar_id = self.get_calendar_id(calendar_name)
-    events = filter_events(self.get_events(calendar_id), **filter_args)
+    events = self.get_events(calendar_id, **filter_args)
     print(f'Clearing {len(events)} events from {calendar_name}...')
     if dry_run:
       print('(DRY RUN)')
       print_events(events)
     else:
-      for i, e in enumerate(events):
-        utils.retry_on_error(
-            self.service.events().delete(
-                calendarId=calendar_id,
-                eventId=e['id']).execute)
-        print(i, end='\r')
-      print()
+      self._delete_events(calendar_id, events)
 
   def add_events(self,
                  calendar_name: str,
@@ -105,45 +399,81 @@ class CalendarApi(object):
                  **filter_args):
     calendar_id = self.get_calendar_id(calendar_name)
     events = filter_events(events, **filter_args)
-    print(f'Adding {len(events)} new events to {calendar_name}...')
-
-    # Find all existing events.  If new events are equal to existing
-    # events, skip them.  However, if new events have the same start time
-    # as existing events but are otherwise not equal, overwrite the
-    # existing event.
-    existing_events = self.get_events(calendar_id)
-    existing_keys = {unique_event_key(e) for e in existing_events}
-    pre_filter_num_events = len(events)
-    events = [e for e in events if unique_event_key(e) not in existing_keys]
-    print(f'{pre_filter_num_events - len(events)} events were '
-          'screened because they already exist on this calendar.')
-    print('Removing exising events with same start time...')
-    event_start_keys = {time_started_event_key(e) for e in events}
-    i = 0
-    for e in existing_events:
-      if time_started_event_key(e) in event_start_keys:
-        utils.retry_on_error(
-            self.service.events().delete(
-                calendarId=calendar_id,
-                eventId=e['id']).execute)
-        i += 1
-        print(i, end='\r')
+    print(f'Reconciling {len(events)} events with {calendar_name}...')
+
+    # Existing events starting at the same time as a new event are updated in
+    # place to match it, so re-adding unchanged events writes nothing.
+    if self.mirror:
+      self._sync_events(calendar_id)
+      # Skip events that already exist using the mirror's index, and only
+      # look at existing events around the remaining ones.
+      num_events = len(events)
+      unchanged_fingerprints = Counter()
+      new_events = []
+      for e in events:
+        fingerprint = event_fingerprint(e)
+        if self.mirror.has_fingerprint(calendar_id, fingerprint):
+          unchanged_fingerprints[fingerprint] += 1
+        else:
+          new_events.append(e)
+      events = new_events
+      existing_events = []
+      if events:
+        existing_events = self.mirror.get_overlapping_events(
+            calendar_id,
+            min(datetime.fromisoformat(e['start']['dateTime'])
+                for e in events),
+            max(datetime.fromisoformat(e['end']['dateTime'])
+                for e in events))
+      # The existing copies of skipped events must be kept as they are, rather
+      # than patched into (or deleted for) new events starting at the same
+      # minute.
+      kept_existing_events = []
+      for e in existing_events:
+        fingerprint = event_fingerprint(e)
+        if unchanged_fingerprints[fingerprint] > 0:
+          unchanged_fingerprints[fingerprint] -= 1
+        else:
+          kept_existing_events.append(e)
+      plan = plan_reconciliation(events, kept_existing_events)
+      plan.num_unchanged += num_events - len(events)
+    else:
+      plan = plan_reconciliation(
+          events, self.get_events(calendar_id, **filter_args))
+    print(f'Plan for {calendar_name}: {plan.summarize()}')
 
     if dry_run:
       print('(DRY RUN)')
-      print_events(events)
+      plan.print_writes()
     else:
-      for event in events:
-        try:
-          response = utils.retry_on_error(
-              self.service.events().insert(
-                  calendarId=calendar_id,
-                  body=event).execute)
-          print(f'Added event {pformat(response)}')
-        except Exception as e:
-          print(f'FAILED to add event {pformat(event)}')
-          print(f'Failure reason: {repr(e)}')
-          raise
+      self.apply_plan(calendar_id, plan)
+
+  def apply_plan(self, calendar_id: str, plan: ReconciliationPlan):
+    # Building the events resource is slow, so reuse it for every request.
+    events_resource = self.service.events()
+    written_events = self.execute_batched(
+        [events_resource.insert(calendarId=calendar_id, body=event)
+         for event in plan.inserts],
+        description='event inserts')
+    written_events += self.execute_batched(
+        [events_resource.patch(calendarId=calendar_id, eventId=e['id'],
+                               body=changed)
+         for e, changed in plan.patches],
+        description='event patches')
+    if self.mirror:
+      self.mirror.upsert(calendar_id, written_events)
+    self._delete_events(calendar_id, plan.deletes)
+
+  def _delete_events(self, calendar_id: str, events: List[CalendarEvent]):
+    events_resource = self.service.events()
+    self.execute_batched(
+        [events_resource.delete(calendarId=calendar_id, eventId=e['id'])
+         for e in events],
+        description='event deletes',
+        # Event was already deleted.
+        ignored_statuses={404, 410})
+    if self.mirror:
+      self.mirror.delete(calendar_id, [e['id'] for e in events])
 
 
 def print_events(events):
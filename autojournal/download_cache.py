@@ -0,0 +1,89 @@
+"""On-disk cache of files downloaded from Google Drive."""
+
+import hashlib
+import os
+import shutil
+import threading
+from typing import BinaryIO, Optional
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+def get_cache_key(file: dict, export_mime_type: str = None) -> str:
+  """Returns a key that changes whenever the file's content does.
+
+  file should be Drive file metadata including md5Checksum and modifiedTime.
+  Google Docs files have no checksum, so they rely on modifiedTime alone.
+  """
+  return hashlib.sha256('|'.join((
+      file['id'], file.get('md5Checksum', ''), file.get('modifiedTime', ''),
+      export_mime_type or '')).encode()).hexdigest()
+
+
+class DownloadCache(object):
+  """Keeps downloaded files in cache_dir, evicting the least recently used
+  ones when the total size goes over max_bytes.
+  """
+
+  def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _path(self, key: str) -> str:
+    return os.path.join(self.cache_dir, key)
+
+  def get(self, key: str, record_stats: bool = True) -> Optional[str]:
+    """Returns the path of the cached file for key, or None if not cached.
+
+    Unless record_stats is False, the lookup counts as a hit or a miss.
+    """
+    path = self._path(key)
+    with self._lock:
+      if not os.path.exists(path):
+        if record_stats:
+          self.misses += 1
+        return None
+      if record_stats:
+        self.hits += 1
+      # The modification time doubles as the last use time for eviction.
+      os.utime(path)
+      return path
+
+  def put(self, key: str, content: BinaryIO) -> str:
+    """Copies the binary file object content into the cache for key and
+    returns the path it was written to.
+    """
+    path = self._path(key)
+    # Write under a temporary name so a half-written file is never served.
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+      shutil.copyfileobj(content, f)
+    os.replace(tmp_path, path)
+    self._evict(keep=key)
+    return path
+
+  def _evict(self, keep: str):
+    with self._lock:
+      entries = []
+      for name in os.listdir(self.cache_dir):
+        if name.endswith('.tmp') or name == keep:
+          continue
+        stat = os.stat(self._path(name))
+        entries.append((stat.st_mtime, stat.st_size, name))
+      total_bytes = (sum(size for _, size, _ in entries)
+                     + os.path.getsize(self._path(keep)))
+      for _, size, name in sorted(entries):
+        if total_bytes <= self.max_bytes:
+          break
+        os.remove(self._path(name))
+        total_bytes -= size
+        self.evictions += 1
+
+  def summarize(self) -> str:
+    return (f'{self.hits} hits, {self.misses} misses, {self.evictions} '
+            f'evictions')
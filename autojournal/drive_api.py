@@ -1,86 +1,370 @@
+import contextlib
 import csv
+import glob
+import hashlib
+import json
+import os
 import os.path as op
 import io
+import shutil
+import tempfile
 import zipfile
+from concurrent.futures import as_completed
 
+import httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 
-from . import utils
+from . import download_cache
+from . import request_executor
+
+# Metadata requested for every listed file.  The checksum and modification time
+# let downloads be served from the download cache.
+FILE_FIELDS = 'id, name, mimeType, md5Checksum, modifiedTime, size'
+# Downloads are fetched in chunks of this size, and kept in memory up to
+# DOWNLOAD_SPOOL_BYTES before being moved to a temporary file on disk.
+DOWNLOAD_CHUNK_BYTES = 8 * 1024**2
+DOWNLOAD_SPOOL_BYTES = 32 * 1024**2
+SPREADSHEET_MIME_TYPES = {
+    'text/comma-separated-values', 'text/csv', 'application/zip',
+    'text/tab-separated-values', 'application/vnd.google-apps.spreadsheet'}
+
+
+class SpreadsheetRows(object):
+  """Rows of a downloaded csv (or zipped csv) file, as dicts.
+
+  Rows are decoded lazily from the downloaded file each time this is iterated,
+  so only a row at a time has to be held in memory.
+  """
+
+  def __init__(self, open_file, name, mime_type):
+    """open_file should return a context manager giving a binary file object
+    positioned at the start of the file.
+    """
+    self._open_file = open_file
+    self.name = name
+    self.mime_type = mime_type
+
+  def __iter__(self):
+    with self._open_file() as f:
+      if self.mime_type == 'application/zip':
+        with zipfile.ZipFile(f) as zf, zf.open(
+            op.splitext(self.name)[0] + '.csv') as member:
+          yield from self._read_rows(member)
+      else:
+        yield from self._read_rows(f)
+
+  def _read_rows(self, binary_file):
+    textio = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+    try:
+      yield from csv.DictReader(
+          textio,
+          delimiter='\t' if self.mime_type == 'text/tab-separated-values'
+          else ',')
+    finally:
+      # Otherwise closing the wrapper would close the file, which may be
+      # reused for the next iteration.
+      textio.detach()
 
 
 class DriveApi(object):
 
-  def __init__(self, creds):
-    self.service = build('drive', 'v3', credentials=creds)
+  def __init__(self, creds, executor=None, cache=None, api_endpoint=None,
+               change_tokens_path=None):
+    """If cache (a download_cache.DownloadCache) is given, unchanged files
+    are read from it instead of being downloaded again.
+
+    If api_endpoint is given, requests are sent there instead of to Google
+    (e.g. to a fake_google_api server) without any credentials.
+
+    If change_tokens_path is given, listing a folder only returns the files
+    added or modified in it since save_change_tokens was last called.  Drive
+    change feed positions for each folder are kept in that file.
+    """
+    if api_endpoint:
+      self.service = build('drive', 'v3', http=httplib2.Http(),
+                           client_options=dict(api_endpoint=api_endpoint))
+    else:
+      self.service = build('drive', 'v3', credentials=creds)
+    self.executor = executor or request_executor.RequestExecutor(creds)
+    self.cache = cache
+    self.change_tokens_path = change_tokens_path
+    # Map from folder name to the change feed page token it was last saved at.
+    self._change_tokens = {}
+    if change_tokens_path and op.exists(change_tokens_path):
+      with open(change_tokens_path, 'r') as f:
+        self._change_tokens = json.load(f)
+    # Tokens to save once the changes listed so far have been processed.
+    self._pending_change_tokens = {}
+    # Map from page token to the changes since it, so that folders at the same
+    # position only read the change feed once.
+    self._changes_since = {}
 
   def read_files(self, directory):
     """Returns dict mapping filename to lines in file for each file in
     given directory.
     """
-    found_files = self._get_files_for_query(
-        f"'{self.get_folder_id(directory)}' in parents")
-    return {file.get('name'): self.get_file_lines(file.get('id'))
-            for file in found_files}
+    found_files = self._get_folder_files(directory)
+    return self._in_order(found_files,
+                          self._iter_concurrently(found_files,
+                                                  self.get_file_lines))
+
+  def iter_files(self, directory):
+    """Yields (filename, lines in file) for each file in given directory.
+
+    Files are downloaded concurrently, and yielded as soon as each finishes so
+    that callers can process them while the rest download.
+    """
+    return self._iter_concurrently(self._get_folder_files(directory),
+                                   self.get_file_lines)
 
-  def read_all_spreadsheet_data(self, directory, only=None):
+  def read_all_spreadsheet_data(self, directory, only=None,
+                                csv_fallback=False):
     """Gets all spreadsheet data from directory.
 
     If the set only is specified, will only get files whose name appears in
-    the only set.
+    the only set.  If csv_fallback is True, files without a spreadsheet
+    mimeType are read as csv instead of skipped.
     """
-    found_files = self._get_files_for_query(
-        f"'{self.get_folder_id(directory)}' in parents")
-    return {file.get('name'): self.get_spreadsheet_data(file)
-            for file in found_files
-            if only is None or file.get('name') in only}
-
-  def get_spreadsheet_data(self, file):
-    if file['mimeType'] not in {
-        'text/comma-separated-values', 'text/csv', 'application/zip',
-        'text/tab-separated-values', 'application/vnd.google-apps.spreadsheet'}:
-      print(f'File {file} not of supported type.')
-      return []
+    found_files = self._get_folder_files(directory, only)
+    return self._in_order(
+        found_files,
+        self._iter_concurrently(
+            found_files,
+            lambda file: self.get_spreadsheet_data(file, csv_fallback)))
+
+  def iter_spreadsheet_data(self, directory, only=None, csv_fallback=False):
+    """Like read_all_spreadsheet_data, but yields (filename, data) pairs as
+    each file finishes downloading.
+    """
+    return self._iter_concurrently(
+        self._get_folder_files(directory, only),
+        lambda file: self.get_spreadsheet_data(file, csv_fallback))
+
+  def _get_folder_files(self, directory, only=None):
+    if self.change_tokens_path:
+      found_files = self.get_changed_files(directory)
+    else:
+      found_files = self._get_files_for_query(
+          f"'{self.get_folder_id(directory)}' in parents")
+    return [file for file in found_files
+            if only is None or file.get('name') in only]
+
+  def get_changed_files(self, directory):
+    """Returns the files in directory added or modified since the last
+    save_change_tokens, or all of them for a folder not seen before.
+    """
+    folder_id = self.get_folder_id(directory)
+    page_token = self._change_tokens.get(directory)
+    if page_token is None:
+      # Get the token before listing, so that changes made while listing are
+      # picked up next time.
+      self._pending_change_tokens[directory] = self.executor.execute(
+          self.service.changes().getStartPageToken(),
+          'drive')['startPageToken']
+      return self._get_files_for_query(f"'{folder_id}' in parents")
+    changes, self._pending_change_tokens[directory] = self._list_changes(
+        page_token)
+    changed_files = {}
+    for change in changes:
+      file = change.get('file')
+      # A later change to the same file supersedes earlier ones, including
+      # when it is removed or moved out of the folder.
+      changed_files.pop(change['fileId'], None)
+      if (not change.get('removed') and file and not file.get('trashed')
+          and folder_id in file.get('parents', [])):
+        changed_files[change['fileId']] = file
+    return list(changed_files.values())
+
+  def _list_changes(self, page_token):
+    """Returns (changes since page_token, page token for after them)."""
+    if page_token not in self._changes_since:
+      changes = []
+      next_page_token = page_token
+      while True:
+        response = self.executor.execute(
+            self.service.changes().list(
+                pageToken=next_page_token,
+                pageSize=1000,
+                spaces='drive',
+                fields=(f'nextPageToken, newStartPageToken, changes(fileId, '
+                        f'removed, file({FILE_FIELDS}, parents, trashed))')),
+            'drive')
+        changes += response.get('changes', [])
+        if 'newStartPageToken' in response:
+          break
+        next_page_token = response['nextPageToken']
+      self._changes_since[page_token] = (
+          changes, response['newStartPageToken'])
+    return self._changes_since[page_token]
+
+  def save_change_tokens(self):
+    """Marks the changed files listed so far as processed, so that they are
+    not listed again by later runs.
+    """
+    if not self.change_tokens_path:
+      return
+    self._change_tokens.update(self._pending_change_tokens)
+    self._pending_change_tokens = {}
+    os.makedirs(op.dirname(self.change_tokens_path) or '.', exist_ok=True)
+    tmp_path = self.change_tokens_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self._change_tokens, f)
+    os.replace(tmp_path, self.change_tokens_path)
+
+  def _iter_concurrently(self, files, read_file):
+    """Reads files on the executor's worker pool, yielding (filename,
+    read_file(file)) in the order they finish.
+    """
+    futures = {self.executor.submit_task(read_file, file): file
+               for file in files}
+    for future in as_completed(futures):
+      yield futures[future].get('name'), future.result()
+
+  @staticmethod
+  def _in_order(files, data_by_name):
+    # Keep the listing order, so results don't depend on download timing.
+    data_by_name = dict(data_by_name)
+    return {file.get('name'): data_by_name[file.get('name')]
+            for file in files}
+
+  def get_spreadsheet_data(self, file, csv_fallback=False):
+    """Returns an iterable of the rows in file as dicts.
+
+    The file is downloaded (or found in the cache) now, but rows are only
+    decoded as they are iterated over.  Files without a spreadsheet mimeType
+    are read as csv if csv_fallback is True, and otherwise skipped.
+    """
+    mime_type = file['mimeType']
+    if mime_type not in SPREADSHEET_MIME_TYPES:
+      if not csv_fallback:
+        print(f'File {file} not of supported type.')
+        return []
+      mime_type = 'text/csv'
+    export_mime_type = None
     if file['mimeType'] == 'application/vnd.google-apps.spreadsheet':
-      dl_file = self.download_file(file.get('id'), export_mime_type='text/csv')
+      export_mime_type = 'text/csv'
+    if self.cache is not None:
+      path = self._get_cached_path(file, export_mime_type)
+      def open_file():
+        nonlocal path
+        try:
+          return open(path, 'rb')
+        except FileNotFoundError:
+          # Evicted since it was cached, so fetch it again.  Only the first
+          # lookup counts towards the cache's hits and misses.
+          path = self._get_cached_path(file, export_mime_type,
+                                       record_stats=False)
+          return open(path, 'rb')
     else:
-      dl_file = self.download_file(file.get('id'))
-    if file['mimeType'] == 'application/zip':
-      dl_file = zipfile.ZipFile(dl_file).open(
-          op.splitext(file.get('name'))[0] + '.csv')
-    textio = io.TextIOWrapper(dl_file, encoding='utf-8')
-    delimiter = ','
-    if file['mimeType'] == 'text/tab-separated-values':
-      delimiter = '\t'
-    return [row for row in csv.DictReader(textio, delimiter=delimiter)]
+      spooled = self.download_file(file['id'], export_mime_type)
+      def open_file():
+        spooled.seek(0)
+        return contextlib.nullcontext(spooled)
+    return SpreadsheetRows(open_file, file.get('name'), mime_type)
 
   def download_file(self, file_id, export_mime_type=None):
+    """Returns a binary file object with the contents of the file.
+
+    Small files are kept in memory, larger ones in a temporary file.
+    """
     def _download():
       if export_mime_type:
         request = self.service.files().export_media(
             fileId=file_id, mimeType=export_mime_type)
       else:
         request = self.service.files().get_media(fileId=file_id)
-      fh = io.BytesIO()
-      downloader = MediaIoBaseDownload(fh, request)
+      # The downloader sends requests with request.http directly.
+      request.http = self.executor.http()
+      fh = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_BYTES)
+      downloader = MediaIoBaseDownload(fh, request,
+                                       chunksize=DOWNLOAD_CHUNK_BYTES)
       done = False
       while done is False:
         status, done = downloader.next_chunk()
         # print("Downloading file %d%%." % int(status.progress() * 100))
       fh.seek(0)
       return fh
-    return utils.retry_on_error(_download)
+    return self.executor.call(_download, 'drive')
+
+  def read_file(self, file, export_mime_type=None):
+    """Returns a binary file object with the contents of the given Drive
+    file, from the cache if possible.
+    """
+    if self.cache is None:
+      return self.download_file(file['id'], export_mime_type)
+    return open(self._get_cached_path(file, export_mime_type), 'rb')
+
+  def _get_cached_path(self, file, export_mime_type=None, record_stats=True):
+    key = download_cache.get_cache_key(file, export_mime_type)
+    path = self.cache.get(key, record_stats)
+    if path is None:
+      with self.download_file(file['id'], export_mime_type) as downloaded:
+        path = self.cache.put(key, downloaded)
+    return path
 
   def download_file_to_disk(self, folder, filename, filepath):
-    folder_id = self.get_folder_id(folder)
-    for file in self._get_files_for_query(f"'{folder_id}' in parents"):
-      if file['name'] == filename:
-        with open(filepath, 'wb') as f:
-          f.write(self.download_file(file['id']).getbuffer())
+    """Downloads the file to filepath, returning whether it was found.
 
-  def get_file_lines(self, file_id):
-    return [ln.decode('utf-8')
-            for ln in self.download_file(file_id).readlines()]
+    When tracking changes, an unchanged file is not found.  If filepath already
+    has the same content as the Drive file, it is left alone.  Otherwise the
+    file is streamed to a partial file next to filepath, which picks up where
+    it left off if a previous download was interrupted, and only moved to
+    filepath once its checksum is verified.
+    """
+    found = False
+    for file in self._get_folder_files(folder, only={filename}):
+      found = True
+      if 'md5Checksum' not in file:
+        # Google Docs files have no checksum or size to resume with.
+        with self.read_file(file) as src, open(filepath, 'wb') as dst:
+          shutil.copyfileobj(src, dst)
+        continue
+      if (op.exists(filepath)
+          and _get_md5_checksum(filepath) == file['md5Checksum']):
+        print(f'{filepath} is already up to date.')
+        continue
+      part_path = f'{filepath}.{file["md5Checksum"]}.part'
+      # Partial downloads of other versions of the file can't be resumed.
+      for old_part_path in glob.glob(glob.escape(filepath) + '.*.part'):
+        if old_part_path != part_path:
+          os.remove(old_part_path)
+      self._download_to_path(file, part_path)
+      if _get_md5_checksum(part_path) != file['md5Checksum']:
+        os.remove(part_path)
+        raise IOError(f'Checksum mismatch downloading {filename} from Drive.')
+      os.replace(part_path, filepath)
+    return found
+
+  def _download_to_path(self, file, path):
+    """Appends the rest of file's content to path, a chunk at a time."""
+    uri = self.service.files().get_media(fileId=file['id']).uri
+    size = int(file['size'])
+    with open(path, 'ab') as f:
+      if f.tell():
+        print(f'Resuming download of {file["name"]} at {f.tell()}/{size} '
+              f'bytes.')
+      while f.tell() < size:
+        start = f.tell()
+        def _get_chunk():
+          resp, content = self.executor.http().request(uri, headers={
+              'range': f'bytes={start}-{start + DOWNLOAD_CHUNK_BYTES - 1}'})
+          if resp.status not in (200, 206):
+            raise HttpError(resp, content, uri=uri)
+          return resp, content
+        resp, content = self.executor.call(_get_chunk, 'drive')
+        if resp.status == 200:
+          # The whole file was sent, rather than the requested range.
+          f.seek(0)
+          f.truncate()
+        if not content:
+          break
+        f.write(content)
+
+  def get_file_lines(self, file):
+    with self.read_file(file) as f:
+      return [ln.decode('utf-8') for ln in f.readlines()]
 
   def get_folder_id(self, folder_name):
     found_files = self._get_files_for_query(
@@ -93,12 +377,12 @@ class DriveApi(object):
     page_token = None
     found_files = []
     while True:
-      response = utils.retry_on_error(
+      response = self.executor.execute(
           self.service.files().list(
               q=query,
               spaces='drive',
-              fields='nextPageToken, files(id, name, mimeType)',
-              pageToken=page_token).execute)
+              fields=f'nextPageToken, files({FILE_FIELDS})',
+              pageToken=page_token), 'drive')
       found_files += response.get('files', [])
       page_token = response.get('nextPageToken', None)
       if page_token is None:
@@ -106,6 +390,14 @@ class DriveApi(object):
     return found_files
 
 
+def _get_md5_checksum(path):
+  md5 = hashlib.md5()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b''):
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
 if __name__ == "__main__":
   import credentials
   creds = credentials.get_credentials([
@@ -0,0 +1,163 @@
+"""Local SQLite mirror of Google calendar events.
+
+Keeps a copy of every event CalendarApi has fetched or written, indexed by
+calendar, start/end time and content fingerprint, along with each calendar's sync
+token.
+"""
+
+import json
+import sqlite3
+from datetime import datetime, timezone
+from typing import Callable, Iterable, List, Optional
+
+# https://developers.google.com/calendar/v3/reference/events
+CalendarEvent = dict
+
+# Bump when changing SCHEMA.  Mirrors with an older schema are rebuilt from
+# scratch, which just means a full sync of each calendar.
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+  calendar_id TEXT NOT NULL,
+  event_id TEXT NOT NULL,
+  -- Fixed format UTC strings, so that they sort chronologically.
+  start_time TEXT NOT NULL,
+  end_time TEXT NOT NULL,
+  fingerprint BLOB NOT NULL,
+  body TEXT NOT NULL,
+  PRIMARY KEY (calendar_id, event_id)
+);
+CREATE INDEX IF NOT EXISTS events_by_start ON events (calendar_id, start_time);
+CREATE INDEX IF NOT EXISTS events_by_end ON events (calendar_id, end_time);
+CREATE INDEX IF NOT EXISTS events_by_fingerprint
+  ON events (calendar_id, fingerprint);
+CREATE TABLE IF NOT EXISTS sync_tokens (
+  calendar_id TEXT PRIMARY KEY,
+  sync_token TEXT NOT NULL
+);
+"""
+
+
+def to_utc_str(t: datetime) -> str:
+  return t.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def get_event_time_utc(event_time: dict) -> datetime:
+  """Returns an event's start or end as a UTC datetime."""
+  if 'dateTime' in event_time:
+    return datetime.fromisoformat(event_time['dateTime']).astimezone(
+        timezone.utc)
+  # All day events only have a date.
+  return datetime.fromisoformat(event_time['date']).replace(
+      tzinfo=timezone.utc)
+
+
+def _event_time_utc_str(event_time: dict) -> str:
+  return to_utc_str(get_event_time_utc(event_time))
+
+
+class EventMirror(object):
+
+  def __init__(self, db_path: str,
+               fingerprint: Callable[[CalendarEvent], bytes]):
+    """fingerprint should return the same value for events with the same
+    content, so that already written events can be found.
+    """
+    self.db = sqlite3.connect(db_path)
+    if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+      self.db.executescript(f"""
+          DROP TABLE IF EXISTS events;
+          DROP TABLE IF EXISTS sync_tokens;
+          {SCHEMA}
+          PRAGMA user_version = {SCHEMA_VERSION};""")
+    self.fingerprint = fingerprint
+
+  def get_sync_token(self, calendar_id: str) -> Optional[str]:
+    row = self.db.execute(
+        'SELECT sync_token FROM sync_tokens WHERE calendar_id = ?',
+        (calendar_id,)).fetchone()
+    return row[0] if row else None
+
+  def apply_changes(self, calendar_id: str,
+                    changes: Iterable[CalendarEvent],
+                    sync_token: str = None, full_sync: bool = False):
+    """Stores changed events, removing cancelled ones.
+
+    If full_sync, changes are all of the calendar's events and replace what was
+    stored before.  The sync token is saved along with the changes, so they are
+    never out of step.
+    """
+    with self.db:
+      if full_sync:
+        self.db.execute('DELETE FROM events WHERE calendar_id = ?',
+                        (calendar_id,))
+      changes = list(changes)
+      self._upsert([e for e in changes if e.get('status') != 'cancelled'],
+                    calendar_id)
+      self._delete([e['id'] for e in changes
+                    if e.get('status') == 'cancelled'], calendar_id)
+      if sync_token:
+        self.db.execute(
+            'INSERT OR REPLACE INTO sync_tokens VALUES (?, ?)',
+            (calendar_id, sync_token))
+
+  def upsert(self, calendar_id: str,
+             events: Iterable[CalendarEvent]):
+    with self.db:
+      self._upsert(events, calendar_id)
+
+  def delete(self, calendar_id: str, event_ids: Iterable[str]):
+    with self.db:
+      self._delete(event_ids, calendar_id)
+
+  def _upsert(self, events, calendar_id):
+    self.db.executemany(
+        'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?)',
+        [(calendar_id, e['id'], _event_time_utc_str(e['start']),
+          _event_time_utc_str(e['end']), self.fingerprint(e),
+          json.dumps(e))
+         for e in events])
+
+  def _delete(self, event_ids, calendar_id):
+    self.db.executemany(
+        'DELETE FROM events WHERE calendar_id = ? AND event_id = ?',
+        [(calendar_id, event_id) for event_id in event_ids])
+
+  def get_events(self, calendar_id: str, start_datetime: datetime = None,
+                 end_datetime: datetime = None
+                 ) -> List[CalendarEvent]:
+    """Gets events that start at or after start_datetime and end at or before
+    end_datetime, sorted by start time.
+    """
+    query = 'SELECT body FROM events WHERE calendar_id = ?'
+    params = [calendar_id]
+    if start_datetime is not None:
+      query += ' AND start_time >= ?'
+      params.append(to_utc_str(start_datetime))
+    if end_datetime is not None:
+      query += ' AND end_time <= ?'
+      params.append(to_utc_str(end_datetime))
+    return [json.loads(body) for body, in
+            self.db.execute(query + ' ORDER BY start_time', params)]
+
+  def get_overlapping_events(
+      self, calendar_id: str, start_datetime: datetime,
+      end_datetime: datetime) -> List[CalendarEvent]:
+    return [json.loads(body) for body, in self.db.execute(
+        'SELECT body FROM events '
+        'WHERE calendar_id = ? AND end_time > ? AND start_time < ? '
+        'ORDER BY start_time',
+        (calendar_id, to_utc_str(start_datetime), to_utc_str(end_datetime)))]
+
+  def has_fingerprint(self, calendar_id: str, fingerprint: bytes) -> bool:
+    return self.db.execute(
+        'SELECT 1 FROM events WHERE calendar_id = ? AND fingerprint = ?',
+        (calendar_id, fingerprint)).fetchone() is not None
+
+  def clear(self, calendar_id: str):
+    """Forgets everything stored for the calendar."""
+    with self.db:
+      self.db.execute('DELETE FROM events WHERE calendar_id = ?',
+                      (calendar_id,))
+      self.db.execute('DELETE FROM sync_tokens WHERE calendar_id = ?',
+                      (calendar_id,))
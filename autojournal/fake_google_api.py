@@ -0,0 +1,403 @@
+"""Local fake of the Google Calendar and Drive HTTP APIs.
+
+Lets the api wrappers be exercised and benchmarked without touching real
+calendars.  The server can add latency to every request and fail a fraction of
+them, to see how the request executor copes.  Point a wrapper at it with its
+api_endpoint argument, or run this file to benchmark calendar writes:
+
+  python -m autojournal.fake_google_api --num_events 5000 --latency_ms 100 \
+      --error_rate 0.05
+
+or with --check to check that reconciling keeps events it should.
+"""
+
+import argparse
+import email.parser
+import hashlib
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+class FakeGoogleApiServer(ThreadingHTTPServer):
+  """Serves an in-memory store of calendars and their events, and of Drive
+  files and their change feed.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, port=0, latency_secs=0.0, error_rate=0.0):
+    super().__init__(('localhost', port), _FakeGoogleApiHandler)
+    # Added to the response time of every http request.
+    self.latency_secs = latency_secs
+    # Fraction of api requests (including those within batches) that fail with
+    # a rate limit or server error.
+    self.error_rate = error_rate
+    self.lock = threading.Lock()
+    # Map from calendar id to summary.
+    self.calendars = {}
+    # Map from calendar id to map from event id to event.  Deleted events are
+    # kept with a 'cancelled' status so they can be reported to syncing
+    # clients.
+    self.events = {}
+    # Map from event id to the value of change_num when it was last changed.
+    self.event_change_nums = {}
+    self.change_num = 0
+    # Sync tokens older than this are rejected as expired.
+    self.min_sync_token = 0
+    # Map from Drive file id to file metadata, and to content.
+    self.drive_files = {}
+    self.drive_contents = {}
+    # Ids of Drive files in the order they were changed.  Page tokens are
+    # positions in this list.
+    self.drive_changes = []
+    # Number of HTTP round trips served (a batch counts once).
+    self.num_http_requests = 0
+
+  @property
+  def url(self) -> str:
+    return f'http://localhost:{self.server_address[1]}/'
+
+  def add_calendar(self, summary: str) -> str:
+    calendar_id = f'{uuid.uuid4().hex}@fake.calendar'
+    with self.lock:
+      self.calendars[calendar_id] = summary
+      self.events[calendar_id] = {}
+    return calendar_id
+
+  def expire_sync_tokens(self):
+    self.min_sync_token = self.change_num + 1
+
+  def _record_change(self, event):
+    self.change_num += 1
+    self.event_change_nums[event['id']] = self.change_num
+
+  def add_drive_folder(self, name: str) -> str:
+    folder_id = uuid.uuid4().hex
+    with self.lock:
+      self.drive_files[folder_id] = dict(
+          id=folder_id, name=name, mimeType=FOLDER_MIME_TYPE, parents=[],
+          trashed=False)
+    return folder_id
+
+  def put_drive_file(self, folder_id: str, name: str, content: bytes,
+                     mime_type: str = 'text/csv') -> str:
+    """Adds a file to the folder, or replaces the content of the file with
+    that name already in it.  Returns the file's id.
+    """
+    with self.lock:
+      file = next((f for f in self.drive_files.values()
+                   if f['name'] == name and folder_id in f['parents']), None)
+      if file is None:
+        file = dict(id=uuid.uuid4().hex, name=name, parents=[folder_id],
+                    trashed=False)
+        self.drive_files[file['id']] = file
+      file.update(mimeType=mime_type, size=str(len(content)),
+                  md5Checksum=hashlib.md5(content).hexdigest(),
+                  modifiedTime=datetime.utcnow().isoformat() + 'Z')
+      self.drive_contents[file['id']] = content
+      self.drive_changes.append(file['id'])
+    return file['id']
+
+  def trash_drive_file(self, file_id: str):
+    with self.lock:
+      self.drive_files[file_id]['trashed'] = True
+      self.drive_changes.append(file_id)
+
+  def start(self):
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+    return self
+
+  def handle_api_request(self, method, path, body):
+    """Returns (status, response dict) for a single (non-batch) request."""
+    if random.random() < self.error_rate:
+      status = random.choice((429, 503))
+      return status, _error(status, 'Injected error')
+    parsed = urlparse(path)
+    query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+    parts = [unquote(p) for p in parsed.path.strip('/').split('/')]
+    if parts == ['users', 'me', 'calendarList'] and method == 'GET':
+      return 200, dict(items=[dict(id=i, summary=s)
+                              for i, s in self.calendars.items()])
+    if parts[0] in ('files', 'changes') and method == 'GET':
+      with self.lock:
+        return self._handle_drive_request(parts, query)
+    if len(parts) < 3 or parts[0] != 'calendars' or parts[2] != 'events':
+      return 404, _error(404, f'Unknown path {parsed.path}')
+    calendar_id = parts[1]
+    if calendar_id not in self.events:
+      return 404, _error(404, f'Unknown calendar {calendar_id}')
+    events = self.events[calendar_id]
+    with self.lock:
+      if len(parts) == 3 and method == 'GET':
+        return self._list_events(events, query)
+      if len(parts) == 3 and method == 'POST':
+        event = dict(json.loads(body), id=uuid.uuid4().hex,
+                     status='confirmed')
+        events[event['id']] = event
+        self._record_change(event)
+        return 200, event
+      event = events.get(parts[3]) if len(parts) == 4 else None
+      if event and event['status'] != 'cancelled':
+        if method == 'DELETE':
+          event['status'] = 'cancelled'
+          self._record_change(event)
+          return 204, None
+        if method == 'PATCH':
+          event.update(json.loads(body))
+          self._record_change(event)
+          return 200, event
+        if method == 'GET':
+          return 200, event
+      if event and method == 'DELETE':
+        return 410, _error(410, 'Resource has been deleted')
+      return 404, _error(404, 'Not Found')
+
+  def _list_events(self, events, query):
+    if 'syncToken' in query:
+      sync_token = int(query['syncToken'])
+      if sync_token < self.min_sync_token:
+        return 410, _error(410, 'Sync token is no longer valid')
+      matching = [e for e in events.values()
+                  if self.event_change_nums[e['id']] > sync_token]
+    else:
+      matching = [e for e in events.values() if e['status'] != 'cancelled']
+    # Like the real api, return events that overlap the given time bounds.
+    if 'timeMin' in query:
+      time_min = datetime.fromisoformat(query['timeMin'])
+      matching = [e for e in matching
+                  if datetime.fromisoformat(e['end']['dateTime']) > time_min]
+    if 'timeMax' in query:
+      time_max = datetime.fromisoformat(query['timeMax'])
+      matching = [e for e in matching
+                  if datetime.fromisoformat(e['start']['dateTime']) < time_max]
+    page_size = int(query.get('maxResults', 250))
+    start = int(query.get('pageToken') or 0)
+    response = dict(items=matching[start:start + page_size])
+    if start + page_size < len(matching):
+      response['nextPageToken'] = str(start + page_size)
+    else:
+      response['nextSyncToken'] = str(self.change_num)
+    return 200, response
+
+
+  def _handle_drive_request(self, parts, query):
+    if parts == ['files']:
+      # Only the kinds of query that DriveApi makes are supported.
+      name = re.search(r"name = '(.*)'", query.get('q', ''))
+      parent = re.search(r"'(.*)' in parents", query.get('q', ''))
+      matching = [f for f in self.drive_files.values() if not f['trashed']]
+      if name:
+        matching = [f for f in matching if f['name'] == name.group(1)]
+      if parent:
+        matching = [f for f in matching if parent.group(1) in f['parents']]
+      if 'mimeType' in query.get('q', ''):
+        matching = [f for f in matching if f['mimeType'] == FOLDER_MIME_TYPE]
+      return 200, dict(files=[dict(f) for f in matching])
+    if parts[0] == 'files' and len(parts) == 2:
+      if parts[1] not in self.drive_files:
+        return 404, _error(404, 'File not found')
+      if query.get('alt') == 'media':
+        return 200, self.drive_contents[parts[1]]
+      return 200, dict(self.drive_files[parts[1]])
+    if parts == ['changes', 'startPageToken']:
+      return 200, dict(startPageToken=str(len(self.drive_changes)))
+    if parts == ['changes']:
+      start = int(query['pageToken'])
+      end = min(start + int(query.get('pageSize', 100)),
+                len(self.drive_changes))
+      response = dict(changes=[
+          dict(fileId=file_id, removed=False,
+               file=dict(self.drive_files[file_id]))
+          for file_id in self.drive_changes[start:end]])
+      if end < len(self.drive_changes):
+        response['nextPageToken'] = str(end)
+      else:
+        response['newStartPageToken'] = str(end)
+      return 200, response
+    return 404, _error(404, f'Unknown path {"/".join(parts)}')
+
+
+def _error(status, message):
+  return dict(error=dict(code=status, message=message))
+
+
+class _FakeGoogleApiHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def _body(self) -> bytes:
+    return self.rfile.read(int(self.headers.get('content-length', 0)))
+
+  def _respond(self, status, content_type, body: bytes):
+    self.send_response(status)
+    self.send_header('content-type', content_type)
+    self.send_header('content-length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _handle(self):
+    body = self._body()
+    with self.server.lock:
+      self.server.num_http_requests += 1
+    time.sleep(self.server.latency_secs)
+    if self.path.startswith('/batch'):
+      self._handle_batch(body)
+      return
+    status, response = self.server.handle_api_request(
+        self.command, self.path, body)
+    if isinstance(response, bytes):
+      # File content, rather than an api response.
+      self._respond_content(response)
+      return
+    self._respond(status, 'application/json',
+                  b'' if response is None else json.dumps(response).encode())
+
+  def _respond_content(self, content: bytes):
+    byte_range = re.fullmatch(r'bytes=(\d+)-(\d*)',
+                              self.headers.get('range', ''))
+    if not byte_range:
+      self._respond(200, 'application/octet-stream', content)
+      return
+    start = int(byte_range.group(1))
+    end = min(int(byte_range.group(2) or len(content) - 1), len(content) - 1)
+    if start > end:
+      self.send_response(416)
+      self.send_header('content-range', f'bytes */{len(content)}')
+      self.send_header('content-length', '0')
+      self.end_headers()
+      return
+    self.send_response(206)
+    self.send_header('content-type', 'application/octet-stream')
+    self.send_header('content-range', f'bytes {start}-{end}/{len(content)}')
+    self.send_header('content-length', str(end - start + 1))
+    self.end_headers()
+    self.wfile.write(content[start:end + 1])
+
+  def _handle_batch(self, body: bytes):
+    message = email.parser.BytesParser().parsebytes(
+        b'content-type: ' + self.headers['content-type'].encode()
+        + b'\r\n\r\n' + body)
+    boundary = uuid.uuid4().hex
+    out = ''
+    for part in message.get_payload():
+      request_line, rest = part.get_payload().split('\n', 1)
+      method, path, _ = request_line.split(' ', 2)
+      sub_body = re.split(r'\r?\n\r?\n', rest, maxsplit=1)[-1]
+      status, response = self.server.handle_api_request(
+          method, path, sub_body)
+      content = '' if response is None else json.dumps(response)
+      content_id = part['Content-ID'][1:-1]
+      out += (f'--{boundary}\r\n'
+              'Content-Type: application/http\r\n'
+              f'Content-ID: <response-{content_id}>\r\n\r\n'
+              f'HTTP/1.1 {status} Fake\r\n'
+              'Content-Type: application/json\r\n'
+              f'Content-Length: {len(content)}\r\n\r\n'
+              f'{content}\r\n')
+    out += f'--{boundary}--\r\n'
+    self._respond(200, f'multipart/mixed; boundary={boundary}', out.encode())
+
+  do_GET = _handle
+  do_POST = _handle
+  do_PATCH = _handle
+  do_DELETE = _handle
+
+
+def make_fake_events(num_events: int):
+  start = datetime(2021, 1, 1, 8)
+  for i in range(num_events):
+    t = start + timedelta(minutes=10 * i)
+    yield dict(
+        start=dict(dateTime=t.isoformat() + '-08:00',
+                   timeZone='America/Los_Angeles'),
+        end=dict(dateTime=(t + timedelta(minutes=5)).isoformat() + '-08:00',
+                 timeZone='America/Los_Angeles'),
+        summary=f'Fake event {i}',
+        description=f'Fake description {i}',
+    )
+
+
+def check_same_minute_events(sync_cache_dir=None):
+  """Checks that add_events keeps an unchanged event when an event starting in
+  the same minute changes, as Nomie and momentodb trackers logged together do.
+  """
+  from . import calendar_api
+
+  server = FakeGoogleApiServer().start()
+  calendar_id = server.add_calendar('Trackers')
+  cal_api_instance = calendar_api.CalendarApi(
+      None, api_endpoint=server.url, sync_cache_dir=sync_cache_dir)
+  a, b = make_fake_events(2)
+  b['start'], b['end'] = a['start'], a['end']
+  cal_api_instance.add_events('Trackers', [a, b])
+  changed_b = dict(b, description='Changed description')
+  cal_api_instance.add_events('Trackers', [a, changed_b])
+  summaries = sorted(
+      (e['summary'], e['description'])
+      for e in server.events[calendar_id].values()
+      if e['status'] != 'cancelled')
+  expected = sorted([(a['summary'], a['description']),
+                     (b['summary'], changed_b['description'])])
+  assert summaries == expected, summaries
+  server.shutdown()
+
+
+def main():
+  from . import calendar_api
+  from . import request_executor
+
+  argparser = argparse.ArgumentParser(
+      description='Benchmark calendar writes against a local fake server.')
+  argparser.add_argument('--num_events', type=int, default=1000)
+  argparser.add_argument('--latency_ms', type=float, default=0)
+  argparser.add_argument('--error_rate', type=float, default=0)
+  argparser.add_argument('--max_workers', type=int, default=8)
+  argparser.add_argument(
+      '--requests_per_sec', type=float,
+      default=request_executor.API_QUOTAS['calendar'][0])
+  argparser.add_argument(
+      '--check', action='store_true', default=False,
+      help='Instead, check that writing events keeps unchanged events starting '
+           'in the same minute as changed ones, with and without a mirror.')
+  args = argparser.parse_args()
+  if args.check:
+    check_same_minute_events()
+    with tempfile.TemporaryDirectory() as sync_cache_dir:
+      check_same_minute_events(sync_cache_dir)
+    print('Same minute events were kept.')
+    return
+
+  server = FakeGoogleApiServer(latency_secs=args.latency_ms / 1000,
+                               error_rate=args.error_rate).start()
+  server.add_calendar('Benchmark')
+  executor = request_executor.RequestExecutor(
+      max_workers=args.max_workers,
+      quotas=dict(calendar=(args.requests_per_sec, calendar_api.BATCH_SIZE)),
+      base_backoff_secs=0.1)
+  cal_api_instance = calendar_api.CalendarApi(
+      None, api_endpoint=server.url, executor=executor)
+  start = time.time()
+  cal_api_instance.add_events('Benchmark', list(make_fake_events(
+      args.num_events)))
+  cal_api_instance.clear_calendar('Benchmark')
+  elapsed = time.time() - start
+  print(f'Wrote {args.num_events} events and cleared them in {elapsed:.2f}s '
+        f'using {server.num_http_requests} http requests.')
+  print(executor.summarize())
+
+
+if __name__ == '__main__':
+  main()
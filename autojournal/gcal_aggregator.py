@@ -4,14 +4,17 @@ from functools import reduce
 from datetime import timedelta, datetime, date
 from dateutil import tz
 import argparse
+import os
 
 from . import credentials
 from . import photos_api
 from . import selfspy_api
 from . import calendar_api
 from . import drive_api
+from . import download_cache
 from . import app_usage_output_parser
 from . import maps_data_parser
+from . import request_executor
 from . import utils
 from .parsers import gps, nomie, momentodb
 
@@ -65,7 +68,58 @@ argparser.add_argument(
     '--end_date', type=str,
     help='Date (inclusive) at which to stop modifying the calendar(s) in '
          'format mm/dd/yyyy.')
+argparser.add_argument(
+    '--sync_cache_dir', type=str, default='calendar_sync_cache',
+    help='Directory to keep a local mirror of the calendars in, so that only '
+         'events changed since the last run are downloaded.  Pass an empty '
+         'string to download whole calendars every time.')
+argparser.add_argument(
+    '--reconcile_mirror', nargs='*', choices=list(calendars.keys()) + ['all'],
+    default=[],
+    help='Calendars to fully re-download into the local mirror, repairing any '
+         'drift from what is actually on the calendar.')
+argparser.add_argument(
+    '--drive_cache_dir', type=str, default='drive_download_cache',
+    help='Directory to cache Google Drive downloads in, so that unchanged '
+         'files are not downloaded again.  Pass an empty string to disable.')
+argparser.add_argument(
+    '--only_changed_files', action='store_true', default=False,
+    help='Only process Google Drive files added or modified since the last '
+         'run that used this flag (or every file, the first time).  Positions '
+         'in the Drive change feed are kept in --drive_change_tokens.')
+argparser.add_argument(
+    '--drive_change_tokens', type=str, default='drive_change_tokens.json',
+    help='File to keep Drive change feed positions in for '
+         '--only_changed_files.')
 args = argparser.parse_args()
+if args.reconcile_mirror and not args.sync_cache_dir:
+  argparser.error('--reconcile_mirror needs a --sync_cache_dir to keep the '
+                  'mirror in.')
+
+
+def get_selfspy_watermark_path(calendar_key):
+  """Returns where to keep the watermark of processed selfspy activity for the
+  calendar, or None if selfspy databases should be processed in full.
+  """
+  # With a date range, events outside it are not written, so they would be
+  # skipped forever if the watermark moved past them.
+  if not args.sync_cache_dir or args.start_date or args.end_date:
+    return None
+  return os.path.join(args.sync_cache_dir,
+                      f'{calendar_key}_selfspy_watermark.json')
+
+
+def add_selfspy_events(cal_api_instance, calendar_key, db_name, cal_mod_args):
+  watermark_path = get_selfspy_watermark_path(calendar_key)
+  watermark = (selfspy_api.Watermark.load(watermark_path) if watermark_path
+               else None)
+  events = selfspy_api.get_selfspy_usage_events(
+      db_name=db_name, watermark=watermark,
+      start_datetime=cal_mod_args.get('start_datetime'),
+      end_datetime=cal_mod_args.get('end_datetime'))
+  cal_api_instance.add_events(calendars[calendar_key], events, **cal_mod_args)
+  if watermark and not args.dry_run:
+    watermark.save(watermark_path)
 
 
 def main():
@@ -75,8 +129,18 @@ def main():
       'https://www.googleapis.com/auth/calendar',
       'https://www.googleapis.com/auth/photoslibrary.readonly'])
 
-  cal_api_instance = calendar_api.CalendarApi(creds)
-  drive_api_instance = drive_api.DriveApi(creds)
+  executor = request_executor.RequestExecutor(creds)
+  cal_api_instance = calendar_api.CalendarApi(
+      creds, sync_cache_dir=args.sync_cache_dir or None, executor=executor,
+      calendar_list_cache_path=(
+          os.path.join(args.sync_cache_dir, 'calendar_list.json')
+          if args.sync_cache_dir else None))
+  drive_api_instance = drive_api.DriveApi(
+      creds, executor=executor,
+      cache=(download_cache.DownloadCache(args.drive_cache_dir)
+             if args.drive_cache_dir else None),
+      change_tokens_path=(
+          args.drive_change_tokens if args.only_changed_files else None))
 
   cal_mod_args = dict(dry_run=args.dry_run)
   if args.start_date:
@@ -86,15 +150,25 @@ def main():
     cal_mod_args['end_datetime'] = datetime.strptime(
         args.end_date, '%m/%d/%Y').replace(tzinfo=tz.gettz('PST'))
 
+  if 'all' in args.reconcile_mirror:
+    args.reconcile_mirror = list(calendars.keys())
+  for c in args.reconcile_mirror:
+    cal_api_instance.reconcile_mirror(calendars[c])
+
   # Clear events from calendars.
   if 'all' in args.clear:
     args.clear = list(calendars.keys())
   for c in args.clear:
     cal_api_instance.clear_calendar(calendars[c], **cal_mod_args)
+    # Cleared selfspy events have to be made again from the beginning.
+    watermark_path = get_selfspy_watermark_path(c)
+    if (not args.dry_run and watermark_path
+        and os.path.exists(watermark_path)):
+      os.remove(watermark_path)
 
   # Add food events from Google Photos.
   if 'all' in args.update or 'food' in args.update:
-    photos_api_instance = photos_api.PhotosApi(creds)
+    photos_api_instance = photos_api.PhotosApi(creds, executor=executor)
     food_pictures = photos_api_instance.get_album_contents(
         photos_api_instance.get_album_id('Food!'))
     # Collapse multiple food pictures taken within 30 mins to one food
@@ -109,31 +183,30 @@ def main():
 
   # Add laptop activity from selfspy
   if 'all' in args.update or 'laptop' in args.update:
-    drive_api_instance.download_file_to_disk(
-        'selfspy-laptop', 'selfspy.sqlite', 'laptop_selfspy.sqlite')
-    laptop_events = selfspy_api.get_selfspy_usage_events(
-        db_name='laptop_selfspy.sqlite')
-    cal_api_instance.add_events(
-        calendars['laptop'], laptop_events,
-        **cal_mod_args)
+    if drive_api_instance.download_file_to_disk(
+        'selfspy-laptop', 'selfspy.sqlite', 'laptop_selfspy.sqlite'):
+      add_selfspy_events(cal_api_instance, 'laptop', 'laptop_selfspy.sqlite',
+                         cal_mod_args)
+    else:
+      print('No new laptop selfspy data.')
 
   # Add desktop activity from selfspy db stored in Google Drive
   if 'all' in args.update or 'desktop' in args.update:
-    drive_api_instance.download_file_to_disk(
-        'selfspy', 'selfspy.sqlite', 'desktop_selfspy.sqlite')
-    desktop_events = selfspy_api.get_selfspy_usage_events(
-        db_name='desktop_selfspy.sqlite')
-    cal_api_instance.add_events(calendars['desktop'], desktop_events,
-                                **cal_mod_args)
+    if drive_api_instance.download_file_to_disk(
+        'selfspy', 'selfspy.sqlite', 'desktop_selfspy.sqlite'):
+      add_selfspy_events(cal_api_instance, 'desktop',
+                         'desktop_selfspy.sqlite', cal_mod_args)
+    else:
+      print('No new desktop selfspy data.')
 
   # Add phone events from phone usage csvs stored in Google Drive
   if 'all' in args.update or 'phone' in args.update:
-    android_activity_files = drive_api_instance.read_files(
-        directory='android-activity-logs')
-    android_events = app_usage_output_parser.create_events(
-        # Combine all "Activity" csvs in directory into single datastream.
-        reduce(list.__add__, [v for k, v in android_activity_files.items()
-                              if 'usage_events' in k]))
+    # The exports are csv, but aren't always uploaded with a csv mimeType.
+    android_activity_files = drive_api_instance.read_all_spreadsheet_data(
+        directory='android-activity-logs', csv_fallback=True)
+    android_events = app_usage_output_parser.create_events_from_exports(
+        # Merge all "Activity" csvs in directory into a single datastream.
+        v for k, v in android_activity_files.items() if 'usage_events' in k)
     cal_api_instance.add_events(calendars['phone'], android_events,
                                 **cal_mod_args)
 
@@ -156,11 +229,13 @@ def main():
     #               **cal_mod_args)
 
     # From GPSLogger files in Google Drive
-    spreadsheet_data = drive_api_instance.read_all_spreadsheet_data(
-        'GPSLogger for Android')
-        # 'GPS TESTING')
-    location_events = [
-        e.to_calendar_event() for e in gps.parse_gps(spreadsheet_data)]
+    # Each file is a separate day, so parse them as their downloads finish.
+    location_events = []
+    for fname, data in drive_api_instance.iter_spreadsheet_data(
+        'GPSLogger for Android'):
+        # 'GPS TESTING'):
+      location_events += [
+          e.to_calendar_event() for e in gps.parse_gps({fname: data})]
     cal_api_instance.add_events(calendars['maps'], location_events,
                                 **cal_mod_args)
 
@@ -179,6 +254,15 @@ def main():
     cal_api_instance.add_events(calendars['momento'], momento_events,
                                 **cal_mod_args)
 
+  # Only now that the changed files have been processed is it safe to skip them
+  # next time.
+  if not args.dry_run:
+    drive_api_instance.save_change_tokens()
+
+  print(f'Google api requests: {executor.summarize()}')
+  if drive_api_instance.cache:
+    print(f'Drive download cache: {drive_api_instance.cache.summarize()}')
+
   # TODO add journal entries
 
   # TODO add github commits
@@ -12,12 +12,16 @@ import statistics
 
 import geopy.distance
 import geopy.geocoders
+import numpy as np
 
 from ..data_model import Event
 
 # Distance between two readings for movement between them to be ignored.
 STATIONARY_DISTANCE_MILES = 0.05
 STATIONARY_TIME_BETWEEN_TRIPS_SECS = 60 * 5
+# WGS-84 ellipsoid, as used by geopy.distance.distance.
+EQUATORIAL_RADIUS_MILES = 6378137 / 1609.344
+FLATTENING = 1 / 298.257223563
 
 location_bank = []
 nominatim = geopy.geocoders.Nominatim(user_agent='autojournal')
@@ -78,6 +82,56 @@ class Location:
     return f'{self.as_point()}, {self.name}'
 
 
+def get_distances_miles(latitudes1, longitudes1, latitudes2, longitudes2):
+  """Returns the distances between arrays of points, which are broadcast
+  against each other.
+
+  Uses Andoyer-Lambert's approximation of the geodesic distance, which is
+  within 2e-6 (relative) of geopy.distance.distance, except for nearly
+  antipodal points.
+  """
+  reduced_latitudes1 = np.arctan(
+      (1 - FLATTENING) * np.tan(np.radians(latitudes1)))
+  reduced_latitudes2 = np.arctan(
+      (1 - FLATTENING) * np.tan(np.radians(latitudes2)))
+  p = (reduced_latitudes1 + reduced_latitudes2) / 2
+  q = (reduced_latitudes2 - reduced_latitudes1) / 2
+  # Central angle on a sphere of the reduced latitudes, by haversine.
+  haversine = (np.sin(q)**2 + np.cos(reduced_latitudes1)
+               * np.cos(reduced_latitudes2)
+               * np.sin(np.radians(np.subtract(longitudes2, longitudes1)) / 2)
+               **2)
+  sigma = 2 * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    x = ((sigma - np.sin(sigma)) * np.sin(p)**2 * np.cos(q)**2
+         / np.cos(sigma / 2)**2)
+    y = ((sigma + np.sin(sigma)) * np.cos(p)**2 * np.sin(q)**2
+         / np.sin(sigma / 2)**2)
+    distances = EQUATORIAL_RADIUS_MILES * (sigma - FLATTENING / 2 * (x + y))
+  return np.where(sigma == 0, 0.0, distances)
+
+
+def get_location_arrays(
+    locations: Sequence[Location]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """Returns arrays of the latitudes, longitudes and accuracies in miles."""
+  return (np.array([l.latitude for l in locations], dtype=float),
+          np.array([l.longitude for l in locations], dtype=float),
+          np.array([l.accuracy_miles for l in locations], dtype=float))
+
+
+def get_pairwise_distances_miles(latitudes, longitudes) -> np.ndarray:
+  """Returns the matrix of distances between every pair of points."""
+  return get_distances_miles(
+      latitudes[:, np.newaxis], longitudes[:, np.newaxis],
+      latitudes[np.newaxis, :], longitudes[np.newaxis, :])
+
+
+def get_consecutive_distances_miles(latitudes, longitudes) -> np.ndarray:
+  """Returns the distances between each point and the next."""
+  return get_distances_miles(latitudes[:-1], longitudes[:-1],
+                             latitudes[1:], longitudes[1:])
+
+
 def are_single_location(
     locations: Sequence[Location], fraction_required: float=0.9,
     samples: Optional[int]=None) -> bool:
@@ -87,25 +141,25 @@ def are_single_location(
     if sample_spacing > 0:
       sampled_locations = [locations[i*sample_spacing] for i in range(samples)]
   num_locations = len(sampled_locations)
-  total_num_matching = 0
-  for l1 in sampled_locations:
-    num_matching_l1 = 0
-    for l2 in sampled_locations:
-      if l1.is_same_place(l2):
-        num_matching_l1 += 1
-    if num_matching_l1 / num_locations > fraction_required:
-      total_num_matching += 1
-  return total_num_matching / num_locations > fraction_required
+  latitudes, longitudes, accuracies = get_location_arrays(sampled_locations)
+  # Same as Location.is_same_place for every pair.
+  same_place = (
+      accuracies[:, np.newaxis] + accuracies[np.newaxis, :]
+      + STATIONARY_DISTANCE_MILES
+      > get_pairwise_distances_miles(latitudes, longitudes))
+  total_num_matching = np.count_nonzero(
+      same_place.sum(axis=1) / num_locations > fraction_required)
+  return bool(total_num_matching / num_locations > fraction_required)
 
 
 def get_traveling_description(
     timestamps: Sequence[datetime], locations: Sequence[Location]) -> str:
-  mph_speeds = [
-      locations[i-1].get_distance(location)
-      / ((timestamp - timestamps[i-1]).total_seconds() / 60 / 60)
-      for i, (timestamp, location) in enumerate(zip(timestamps, locations))
-      if i > 0
-  ]
+  latitudes, longitudes, _ = get_location_arrays(locations)
+  hours = np.array([(timestamp - previous_timestamp).total_seconds() / 60 / 60
+                    for previous_timestamp, timestamp
+                    in zip(timestamps, timestamps[1:])])
+  mph_speeds = (
+      get_consecutive_distances_miles(latitudes, longitudes) / hours).tolist()
   if not mph_speeds:
     return 'not enough data'
   average_mph_speed = statistics.mean(mph_speeds)
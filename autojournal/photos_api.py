@@ -1,6 +1,8 @@
 from typing import List
 from googleapiclient.discovery import build
 
+from . import request_executor
+
 
 # https://developers.google.com/photos/library/reference/rest/v1/mediaItems
 mediaItem = dict
@@ -11,20 +13,21 @@ mediaItem = dict
 
 class PhotosApi(object):
 
-  def __init__(self, creds):
+  def __init__(self, creds, executor=None):
     self.service = build(
       'photoslibrary', 'v1', credentials=creds, static_discovery=False)
+    self.executor = executor or request_executor.RequestExecutor(creds)
 
   def get_album_id(self, name: str) -> str:
     albums = []
     page_token = None
     while page_token != '':
       page_token = '' if not page_token else page_token
-      results = self.service.albums().list(
+      results = self.executor.execute(self.service.albums().list(
           pageToken=page_token,
           pageSize=10,
           fields="nextPageToken,albums(id,title)",
-      ).execute()
+      ), 'photos')
       albums += results.get('albums', [])
       page_token = results.get('nextPageToken', '')
     for album in albums:
@@ -38,10 +41,10 @@ class PhotosApi(object):
     page_token = None
     while page_token != '':
       page_token = '' if not page_token else page_token
-      results = self.service.mediaItems().search(
+      results = self.executor.execute(self.service.mediaItems().search(
         body=dict(pageSize=25, pageToken=page_token,
               albumId=album_id)
-      ).execute()
+      ), 'photos')
       photos += results.get('mediaItems', [])
       page_token = results.get('nextPageToken', '')
     return photos
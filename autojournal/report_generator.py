@@ -11,7 +11,9 @@ import plotly.express as px
 
 from . import credentials
 from . import drive_api
+from . import download_cache
 from . import calendar_api
+from . import request_executor
 from .parsers import cronometer
 from .parsers import cgm
 from .parsers import nomie
@@ -193,15 +195,19 @@ def main(start_date: str, end_date: str, use_cache: bool):
         'https://www.googleapis.com/auth/calendar',
         'https://www.googleapis.com/auth/photoslibrary.readonly'
     ])
-    drive_api_instance = drive_api.DriveApi(creds)
-    cal_api_instance = calendar_api.CalendarApi(creds)
+    executor = request_executor.RequestExecutor(creds)
+    drive_api_instance = drive_api.DriveApi(
+        creds, executor=executor,
+        cache=download_cache.DownloadCache('drive_download_cache'))
+    cal_api_instance = calendar_api.CalendarApi(
+        creds, executor=executor, sync_cache_dir='calendar_sync_cache')
     print('Done setting up google APIs')
 
     event_data = []
     spreadsheet_data = {}
     print('Getting sleep data...')
     sleep_data = cal_api_instance.get_events(
-        cal_api_instance.get_calendar_id('Sleep'))
+        cal_api_instance.get_calendar_id('Sleep'), start_date, end_date)
     for e in sleep_data:
       event_data.append(Event(
           summary='',
@@ -0,0 +1,175 @@
+"""Shared executor for Google api requests.
+
+Requests run on a bounded pool of worker threads, are rate limited per api with
+a token bucket, and are retried with jittered exponential backoff when Google
+reports rate limiting or server errors.
+"""
+
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable
+
+import google_auth_httplib2
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+# Approximate default per-user quotas, in (requests per second, burst size).
+# Batched requests count once per request inside the batch.
+API_QUOTAS = {
+    'calendar': (10, 50),
+    'drive': (20, 50),
+    'photos': (5, 10),
+}
+RETRYABLE_ERRORS = (BrokenPipeError, ConnectionResetError, socket.timeout,
+                    httplib2.ServerNotFoundError)
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# 403 responses are only worth retrying if they are about rate limits.
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+def is_retryable(e: Exception) -> bool:
+  if isinstance(e, HttpError):
+    if e.resp.status == 403:
+      return any(reason in str(e.content) for reason in RATE_LIMIT_REASONS)
+    return e.resp.status in RETRYABLE_STATUSES
+  return isinstance(e, RETRYABLE_ERRORS)
+
+
+class TokenBucket(object):
+  """Allows rate tokens per second on average, and up to capacity at once."""
+
+  def __init__(self, rate: float, capacity: float):
+    self.rate = rate
+    self.capacity = capacity
+    self._tokens = capacity
+    self._last_refill = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self, tokens: float = 1) -> float:
+    """Blocks until tokens are available and returns the seconds waited."""
+    # Requests larger than the bucket would otherwise wait forever.
+    tokens = min(tokens, self.capacity)
+    waited = 0.0
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+        if self._tokens >= tokens:
+          self._tokens -= tokens
+          return waited
+        wait = (tokens - self._tokens) / self.rate
+      time.sleep(wait)
+      waited += wait
+
+
+class RequestExecutor(object):
+  """Runs api requests through shared rate limits, retries and worker pool.
+
+  One instance should be shared by all the api wrappers in a process, so that
+  their requests are limited together.  If creds is None, requests are sent
+  without credentials (e.g. to a fake_google_api server).
+  """
+
+  def __init__(self, creds=None, max_workers=8, quotas=None,
+               num_retries=6, base_backoff_secs=1, max_backoff_secs=64):
+    self.creds = creds
+    self.num_retries = num_retries
+    self.base_backoff_secs = base_backoff_secs
+    self.max_backoff_secs = max_backoff_secs
+    self._buckets = {api: TokenBucket(rate, capacity)
+                     for api, (rate, capacity)
+                     in (quotas or API_QUOTAS).items()}
+    self._pool = ThreadPoolExecutor(max_workers=max_workers)
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    # Number of requests currently being sent.
+    self.in_flight = 0
+    # Number of times a failed request was tried again.
+    self.retries = 0
+    # Number of requests that had to wait for their api's rate limit.
+    self.throttled = 0
+    self.throttled_secs = 0.0
+    self.completed = 0
+
+  def http(self) -> httplib2.Http:
+    """Returns an http object for the calling thread.
+
+    httplib2 objects are not thread safe, so each worker gets its own.
+    """
+    if not hasattr(self._local, 'http'):
+      http = httplib2.Http()
+      if self.creds is not None:
+        http = google_auth_httplib2.AuthorizedHttp(self.creds, http=http)
+      self._local.http = http
+    return self._local.http
+
+  def backoff_secs(self, attempt: int) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(
+        0, min(self.max_backoff_secs, self.base_backoff_secs * 2**attempt))
+
+  def call(self, function: Callable, api: str, cost: float = 1):
+    """Calls function on this thread within api's rate limit, retrying it if it
+    fails with a retryable error.
+    """
+    for attempt in range(self.num_retries + 1):
+      waited = self._buckets[api].acquire(cost)
+      with self._lock:
+        if waited:
+          self.throttled += 1
+          self.throttled_secs += waited
+        self.in_flight += 1
+      try:
+        result = function()
+      except Exception as e:
+        if not is_retryable(e) or attempt == self.num_retries:
+          raise
+        error = e
+      else:
+        with self._lock:
+          self.completed += 1
+        return result
+      finally:
+        with self._lock:
+          self.in_flight -= 1
+      sleep_secs = self.backoff_secs(attempt)
+      retry_after = (error.resp.get('retry-after')
+                     if isinstance(error, HttpError) else None)
+      if retry_after and retry_after.isdigit():
+        sleep_secs = max(sleep_secs, float(retry_after))
+      print(f'Hit {error!r}, retrying in {sleep_secs:.1f}s '
+            f'(attempt {attempt + 1}/{self.num_retries})')
+      self.record_retries(1)
+      time.sleep(sleep_secs)
+
+  def record_retries(self, num_retries: int):
+    """Counts retries made by callers, e.g. of failed parts of a batch."""
+    with self._lock:
+      self.retries += num_retries
+
+  def execute(self, request, api: str, cost: float = 1):
+    """Executes a googleapiclient request or batch on this thread."""
+    return self.call(lambda: request.execute(http=self.http()), api, cost)
+
+  def submit(self, request, api: str, cost: float = 1) -> Future:
+    """Executes a googleapiclient request or batch on the worker pool."""
+    return self._pool.submit(self.execute, request, api, cost)
+
+  def submit_task(self, function: Callable, *args) -> Future:
+    """Runs function on the worker pool.
+
+    function should send its requests with call or execute, and must not
+    wait on other tasks in the pool.
+    """
+    return self._pool.submit(function, *args)
+
+  def summarize(self) -> str:
+    return (f'{self.completed} requests completed, {self.in_flight} in '
+            f'flight, {self.retries} retries, {self.throttled} throttled for '
+            f'{self.throttled_secs:.1f}s total')
@@ -1,34 +1,63 @@
 import os
+import argparse
 import copy
+import json
+import random
 import re
-from typing import List, Any
+import sqlite3
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Any, Optional
 from datetime import datetime, timedelta
 from dateutil import tz
-from collections import namedtuple
 from dataclasses import dataclass
 from collections import defaultdict
 from functools import reduce
+from itertools import repeat
 from pprint import pprint
+import numpy as np
 import psutil
 
 from sortedcontainers import SortedList
 from selfspy.modules import models, config as cfg
-from selfspy.stats import create_times
 
 from . import calendar_api
 from . import utils
 
 
-ActionTiming = namedtuple('ActionTiming', [
-  'time',  # type datetime
-  'num_moves',  # type int, zero if this is a keystroke, nonzero if is a
-          # click selfspy stores amount of mouse movement before a
-          # click in the same row, so we carry through that infomation
-          # here.
-])
+def epoch_us_to_datetime(epoch_us: int) -> datetime:
+  """Converts microseconds since the epoch to a naive local datetime."""
+  epoch_us = int(epoch_us)
+  return datetime.fromtimestamp(epoch_us // 10**6).replace(
+    microsecond=epoch_us % 10**6)
 
 
-@dataclass
+def datetime_to_epoch_us(t: datetime) -> int:
+  """Converts a naive local datetime to microseconds since the epoch."""
+  return int(t.replace(microsecond=0).timestamp()) * 10**6 + t.microsecond
+
+
+def timestamps_to_epoch_us(timestamps: np.ndarray) -> np.ndarray:
+  """Converts float seconds since the epoch to microseconds, rounding the
+  same way as datetime.fromtimestamp.
+  """
+  seconds = np.trunc(timestamps)
+  return (seconds.astype(np.int64) * 10**6
+          + np.rint((timestamps - seconds) * 10**6).astype(np.int64))
+
+
+def get_gap_split_points(starts: np.ndarray, ends: np.ndarray,
+                         threshold: timedelta) -> np.ndarray:
+  """Returns the indices i where starts[i] is more than threshold after
+  ends[i - 1], for times in microseconds.
+  """
+  return np.flatnonzero(
+    starts[1:] - ends[:-1] > threshold // timedelta(microseconds=1)) + 1
+
+
+@dataclass(eq=False)
 class WindowSession:
   """Describes the time spent in a single window.
 
@@ -38,27 +67,51 @@ class WindowSession:
   title: str = None
   # Name of the program that this window is an instance of.
   program_name: str = None
-  # Timestamp for each action that happened while in this window.  There is
-  # always one "action" when the window is moved to.  It's safe to say that
-  # the time in a window is the last time in this list minus the first time.
+  # Time of each action that happened while in this window, in microseconds
+  # since the epoch, sorted.  There is always one "action" when the window is
+  # moved to.  It's safe to say that the time in a window is the last time in
+  # this array minus the first time.
   # TODO might be a bug here where the actions do not quite give the time in
   # the window accurately.  For instance, if a key is pressed to go to a
   # window, then no actions are taken for a while, it might be that the
   # window session for the window "starts" when the first key is pressed,
   # which is inaccurate.
-  action_timings: 'Any' = None  # SortedList[ActionTiming]
+  times: np.ndarray = None
+  # For each action, zero if it is a keystroke, nonzero if it is a click.
+  # selfspy stores the amount of mouse movement before a click in the same
+  # row, so we carry through that information here.
+  num_moves: np.ndarray = None
+
+  def get_start_key(self):
+    """Sort key putting sessions in order of their first action."""
+    return (self.times[0], self.num_moves[0])
+
+  def get_start_time(self) -> datetime:
+    return epoch_us_to_datetime(self.times[0])
+
+  def get_end_time(self) -> datetime:
+    return epoch_us_to_datetime(self.times[-1])
 
   def get_total_time(self):
-    return self.action_timings[-1].time - self.action_timings[0].time
+    return timedelta(microseconds=int(self.times[-1] - self.times[0]))
 
   def get_total_actions_by_type(self):
+    num_clicks = int(np.count_nonzero(self.num_moves))
     return dict(
-      keystrokes=len([a for a in self.action_timings
-              if a.num_moves == 0]),
-      clicks=len([a for a in self.action_timings if a.num_moves != 0]),
-      mouse_moves=sum([a.num_moves for a in self.action_timings]),
+      keystrokes=len(self.num_moves) - num_clicks,
+      clicks=num_clicks,
+      mouse_moves=int(self.num_moves.sum()),
     )
 
+  def split_on_gaps(self, threshold: timedelta) -> List['WindowSession']:
+    """Splits this session wherever no action happened for over threshold."""
+    split_points = get_gap_split_points(self.times, self.times, threshold)
+    return [
+      WindowSession(title=self.title, program_name=self.program_name,
+              times=times, num_moves=num_moves)
+      for times, num_moves in zip(np.split(self.times, split_points),
+                                  np.split(self.num_moves, split_points))]
+
   def summarize(self):
     actions = ', '.join([
       f'{v} {k}' for k, v in self.get_total_actions_by_type().items()])
@@ -70,9 +123,12 @@ def get_total_time_of_sessions(sessions: List[WindowSession]):
   return sum([s.get_total_time().total_seconds() for s in sessions])
 
 
+def get_time_str(secs: float):
+  return utils.strfdelta(timedelta(seconds=secs))
+
+
 def get_total_time_of_sessions_str(sessions: List[WindowSession]):
-  return utils.strfdelta(
-    timedelta(seconds=get_total_time_of_sessions(sessions)))
+  return get_time_str(get_total_time_of_sessions(sessions))
 
 
 def remove_urls(s):
@@ -87,42 +143,68 @@ def remove_redundancy(string):
   return reduce(lambda s, r: s.replace(r, ''), redundants, string)
 
 
-def get_session_group_description(sessions: List[WindowSession], long=True):
-  unique_sessions = defaultdict(list)
-  for s in sessions:
-    unique_sessions[s.title].append(s)
-  # Sort unique_sessions by the total time of each group of sessions, longest
-  # first.
-  unique_sessions = sorted(
-    unique_sessions.items(),
-    key=lambda t: get_total_time_of_sessions(t[1]))[::-1]
-
-  total_actions = reduce(
-    lambda d1, d2: {k: d1[k] + d2[k] for k in d1.keys()},
-    [s.get_total_actions_by_type() for s in sessions])
+@dataclass
+class SessionGroupTotals:
+  """Time spent and actions taken in a group of sessions, overall and for
+  each window title.
+  """
+  num_sessions: int = 0
+  # Seconds from the first action in the group to the last.
+  span_secs: float = 0
+  # Seconds spent in the sessions themselves.
+  total_secs: float = 0
+  actions: Dict[str, int] = None
+  # Both keyed by window title, in the order the titles were first used.
+  secs_by_title: Dict[str, float] = None
+  actions_by_title: Dict[str, Dict[str, int]] = None
+
+  @classmethod
+  def from_sessions(cls, sessions: List[WindowSession]):
+    """Adds up the sessions in a single pass."""
+    totals = cls(
+      num_sessions=len(sessions),
+      span_secs=(sessions[-1].get_end_time()
+                 - sessions[0].get_start_time()).total_seconds(),
+      actions=dict(keystrokes=0, clicks=0, mouse_moves=0),
+      secs_by_title=defaultdict(int),
+      actions_by_title={})
+    for s in sessions:
+      secs = s.get_total_time().total_seconds()
+      totals.total_secs += secs
+      totals.secs_by_title[s.title] += secs
+      title_actions = totals.actions_by_title.setdefault(
+        s.title, dict(keystrokes=0, clicks=0, mouse_moves=0))
+      for k, v in s.get_total_actions_by_type().items():
+        totals.actions[k] += v
+        title_actions[k] += v
+    return totals
+
+  def get_titles_by_time(self) -> List[str]:
+    """Returns the titles used, the one used the longest first."""
+    return [title for title, _ in sorted(
+      self.secs_by_title.items(), key=lambda t: t[1])[::-1]]
+
+
+def get_session_group_description(totals: SessionGroupTotals, long=True):
   action_summary = ''
-  for k, v in total_actions.items():
+  for k, v in totals.actions.items():
     action_summary += f'{v} {k} ({round(v / 60, 2)} {k} per minute)\n'
   # TODO rank windows both by time used AND by keystrokes/mouse actions
   # within.
   if long:
-    desc = f"""Used computer for {get_total_time_of_sessions_str(sessions)}.
+    desc = f"""Used computer for {get_time_str(totals.total_secs)}.
 
 {action_summary}
-Windows used ({len(sessions)} total switches):
+Windows used ({totals.num_sessions} total switches):
 
 """
-    for title, ss in unique_sessions:
-      title = remove_redundancy(title)
-      actions = reduce(
-        lambda d1, d2: {k: d1[k] + d2[k] for k in d1.keys()},
-        [s.get_total_actions_by_type() for s in ss])
+    for title in totals.get_titles_by_time():
       actions_str = ', '.join(
-        [f'{v} {k}' for k, v in actions.items()]
+        [f'{v} {k}' for k, v in totals.actions_by_title[title].items()]
       ).replace('keystrokes', 'k').replace('clicks', 'c').replace(
         'mouse_moves', 'm')  # Save some characters
-      row = (f'{get_total_time_of_sessions_str(ss)} : {title} '
-           f'--- {actions_str}\n')
+      row = (f'{get_time_str(totals.secs_by_title[title])} : '
+           f'{remove_redundancy(title)} --- {actions_str}\n')
       if (len(desc) + len(row)
           > calendar_api.EVENT_DESCRIPTION_LENGTH_LIMIT):
         break
@@ -132,62 +214,296 @@ Windows used ({len(sessions)} total switches):
     # Get events that make up majority of time in session
     top_session_titles = []
     percent_left = 100
-    total_secs = get_total_time_of_sessions(sessions)
+    total_secs = totals.total_secs
     # Round up to at least 0.01 to avoid div by zero errors.
     if total_secs == 0:
       total_secs = 0.01
-    for title, ss in unique_sessions:
+    for title in totals.get_titles_by_time():
       top_session_titles.append(remove_urls(remove_redundancy(
         title.replace('\n', ' '))))
-      percent_left -= (get_total_time_of_sessions(ss) / total_secs) * 100
+      percent_left -= (totals.secs_by_title[title] / total_secs) * 100
       if percent_left < 25:
         break
-    kpm = round(total_actions['keystrokes'] / 60, 2)
-    cpm = round(total_actions['clicks'] / 60, 2)
+    kpm = round(totals.actions['keystrokes'] / 60, 2)
+    cpm = round(totals.actions['clicks'] / 60, 2)
     try:
-      percent_active = round(
-        100 * total_secs / (
-          sessions[-1].action_timings[-1].time
-          - sessions[0].action_timings[0].time).total_seconds(),
-        1)
+      percent_active = round(100 * total_secs / totals.span_secs, 1)
     except ZeroDivisionError:
       percent_active = '0.0'
-    return f"""{get_total_time_of_sessions_str(sessions)} Active
+    return f"""{get_time_str(totals.total_secs)} Active
  ({percent_active}%)
  -- {' | '.join(top_session_titles)[:50]}
  -- {kpm}kpm, {cpm}cpm.""".replace('\n', '')
 
 
-def get_window_sessions(db_name):
+# Number of rows fetched from the selfspy database at a time.
+SQL_CHUNK_ROWS = 10000
+# Number of Keys row ids decoded by each worker process task.
+DECODE_CHUNK_ROWS = 20000
+
+
+class _KeysRow(object):
+  """Just enough of a models.Keys row to decode its timings."""
+  __slots__ = ('timings',)
+  load_timings = models.Keys.load_timings
+
+
+def _parse_db_time(db_time: str) -> datetime:
+  # SQLAlchemy stores datetimes as 'YYYY-MM-DD HH:MM:SS.ffffff' strings.
+  return datetime.fromisoformat(db_time)
+
+
+def _iter_query(db, query, params=()):
+  """Yields the rows of query, fetching SQL_CHUNK_ROWS of them at a time."""
+  cursor = db.execute(query, params)
+  while True:
+    rows = cursor.fetchmany(SQL_CHUNK_ROWS)
+    if not rows:
+      return
+    yield from rows
+
+
+def _to_db_time(t: datetime) -> str:
+  return t.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def _to_local_time(t: datetime) -> datetime:
+  """Converts t to the naive local time selfspy stores."""
+  if t.tzinfo is None:
+    return t
+  return t.astimezone(tz.gettz('PST')).replace(tzinfo=None)
+
+
+def _connect(db_name):
+  return sqlite3.connect(f'file:{db_name}?mode=ro', uri=True)
+
+
+def _decode_keys_rows(db_name, first_id, end_id):
+  """Reads the Keys rows with ids in [first_id, end_id).
+
+  Returns their titles, program names, numbers of actions, and the times of all
+  their actions concatenated, in microseconds since the epoch.
+  """
+  db = _connect(db_name)
+  titles, program_names, num_actions, row_times = [], [], [], []
+  keys_row = _KeysRow()
+  for created_at, timings, title, program_name in _iter_query(db, """
+      SELECT keys.created_at, keys.timings, window.title, process.name
+      FROM keys
+      LEFT JOIN window ON window.id = keys.window_id
+      LEFT JOIN process ON process.id = keys.process_id
+      WHERE keys.id >= ? AND keys.id < ?
+      ORDER BY keys.id""", (first_id, end_id)):
+    keys_row.timings = timings
+    # Same as selfspy.stats.create_times: the row is created at its last key
+    # press, and its timings are the gaps between the earlier ones.
+    times = np.subtract.accumulate(np.array(
+        [time.mktime(_parse_db_time(created_at).timetuple()),
+         *keys_row.load_timings()], dtype=np.float64))[::-1]
+    titles.append(str(title))
+    program_names.append(program_name)
+    num_actions.append(len(times))
+    row_times.append(times)
+  db.close()
+  times = (timestamps_to_epoch_us(np.concatenate(row_times)) if row_times
+           else np.zeros(0, dtype=np.int64))
+  return titles, program_names, np.array(num_actions, dtype=np.int64), times
+
+
+@dataclass
+class Watermark:
+  """How far incremental processing of a selfspy database has got."""
+  # Highest ids of the Keys and Click rows processed.
+  keys_id: int = 0
+  click_id: int = 0
+  # Start of the last group of activity processed, which may still be growing
+  # when more activity is recorded, in the database's time format.
+  trailing_group_start: str = None
+  # calendar_api.event_fingerprint of the last event made, in hex.
+  trailing_event_fingerprint: str = None
+
+  @classmethod
+  def load(cls, path: str) -> 'Watermark':
+    """Loads the watermark saved at path, or a fresh one if there is none."""
+    if not os.path.exists(path):
+      return cls()
+    with open(path, 'r') as f:
+      return cls(**json.load(f))
+
+  def save(self, path: str):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.__dict__, f)
+    os.replace(tmp_path, path)
+
+
+def get_window_sessions(db_name, since: datetime = None, until: datetime = None,
+                        session_limit: int = None, num_workers: int = None):
+  """Gets sessions from the selfspy database.
+
+  If since or until are given, only sessions that can have actions between them
+  are read, along with the clicks that happened during them.  If session_limit
+  is given, only that many of the last sessions are read.  num_workers
+  processes decode the rows, defaulting to one per cpu.
+  """
+  window_sessions = []
+
+  # Plain SQL avoids the ORM loading every row (and lazily loading each
+  # row's window and process) into memory at once.
+  db = _connect(db_name)
+
+  first_keys_id, last_keys_id = db.execute(
+      'SELECT MIN(id), MAX(id) FROM keys').fetchone()
+  if first_keys_id is None:
+    db.close()
+    return window_sessions
+  if since:
+    # Rows are created at the last key press of their session, but clicks
+    # after that still go to the session until the next one starts.  So start
+    # from the last session to end before since.
+    row = db.execute(
+        'SELECT id FROM keys WHERE created_at < ? '
+        'ORDER BY created_at DESC LIMIT 1', (_to_db_time(since),)).fetchone()
+    if row:
+      first_keys_id = row[0]
+  if until:
+    # The first session to end after until can have key presses before it.
+    row = db.execute(
+        'SELECT id FROM keys WHERE created_at > ? '
+        'ORDER BY created_at LIMIT 1', (_to_db_time(until),)).fetchone()
+    if row:
+      last_keys_id = row[0]
+  if session_limit:
+    row = db.execute(
+        'SELECT id FROM keys WHERE id BETWEEN ? AND ? '
+        'ORDER BY id DESC LIMIT 1 OFFSET ?',
+        (first_keys_id, last_keys_id, session_limit - 1)).fetchone()
+    if row:
+      first_keys_id = row[0]
+
+  # Query "Keys" table for action times and basic window info.  Decoding the
+  # timings is the slow part, so ranges of rows are decoded in parallel.
+  first_ids = list(
+      range(first_keys_id, last_keys_id + 1, DECODE_CHUNK_ROWS))
+  end_ids = first_ids[1:] + [last_keys_id + 1] if first_ids else []
+  with ProcessPoolExecutor(num_workers) as pool:
+    # With one range, the time to start a worker would be wasted.
+    decoded = (map if len(first_ids) < 2 else pool.map)(
+        _decode_keys_rows, repeat(db_name, len(first_ids)), first_ids, end_ids)
+    # map returns results in order of id, whatever order they finish in.
+    for titles, program_names, num_actions, times in decoded:
+      split_points = np.cumsum(num_actions)[:-1]
+      num_moves = np.zeros(len(times), dtype=np.int64)
+      for title, program_name, session_times, session_moves in zip(
+          titles, program_names, np.split(times, split_points),
+          np.split(num_moves, split_points)):
+        window_sessions.append(
+          WindowSession(
+            title=title,
+            program_name=program_name,
+            times=session_times,
+            num_moves=session_moves))
   # Sessions sorted by the first action that occured in them.
-  window_sessions = SortedList(key=lambda ws: ws.action_timings[0])
-
-  # Query "Keys" table for action_timings and basic window info.
-  session = models.initialize(db_name)()
-  for keys_row in session.query(models.Keys).order_by(models.Keys.id).all():
-    window_sessions.add(
-      WindowSession(
-        title=str(keys_row.window.title),
-        program_name=keys_row.process.name,
-        action_timings=SortedList(
-          [ActionTiming(
-            time=datetime.fromtimestamp(t),
-            num_moves=0)
-           for t in create_times(keys_row)])))
+  window_sessions.sort(key=WindowSession.get_start_key)
+  if not window_sessions:
+    db.close()
+    return window_sessions
+
+  click_conditions = []
+  click_params = []
+  if since or session_limit:
+    # Earlier clicks belong to sessions that were not read.
+    click_conditions.append('created_at >= ?')
+    click_params.append(_to_db_time(window_sessions[0].get_start_time()))
+  if until:
+    click_conditions.append('created_at <= ?')
+    click_params.append(_to_db_time(until))
+  click_query = 'SELECT created_at, nrmoves FROM click'
+  if click_conditions:
+    click_query += ' WHERE ' + ' AND '.join(click_conditions)
+  click_query += ' ORDER BY id'
 
   # Query "Clicks" table to fill out mouse data in window_sessions.
-  for click_row in session.query(
-      models.Click).order_by(models.Click.id).all():
-    click_row_tuple = ActionTiming(
-      time=click_row.created_at,
-      num_moves=click_row.nrmoves)
-    idx = window_sessions.bisect_left(
-      WindowSession(action_timings=[click_row_tuple])) - 1
-    window_sessions[idx].action_timings.add(click_row_tuple)
-
+  click_times, click_moves = _read_clicks(db, click_query, click_params)
+  db.close()
+  assign_clicks(window_sessions, click_times, click_moves)
   return window_sessions
 
 
+def _read_clicks(db, query, params=()):
+  """Returns the times (in microseconds since the epoch) and numbers of mouse
+  moves of the clicks selected by query.
+  """
+  click_times = []
+  click_moves = []
+  for created_at, nrmoves in _iter_query(db, query, params):
+    click_times.append(datetime_to_epoch_us(_parse_db_time(created_at)))
+    click_moves.append(nrmoves)
+  return (np.array(click_times, dtype=np.int64),
+          np.array(click_moves, dtype=np.int64))
+
+
+def assign_clicks(window_sessions: List[WindowSession],
+                  click_times: np.ndarray, click_moves: np.ndarray):
+  """Adds each click to the last session starting before it.
+
+  window_sessions must be sorted by their first action.  Clicks before the
+  first session are dropped.
+  """
+  session_starts = np.array([s.times[0] for s in window_sessions])
+  # A click at the same time as a session's first keystroke goes after it,
+  # unless the click has no mouse moves, in which case it sorts as a keystroke
+  # would.
+  session_idxs = np.where(
+    click_moves > 0,
+    np.searchsorted(session_starts, click_times, side='right'),
+    np.searchsorted(session_starts, click_times, side='left')) - 1
+  kept = session_idxs >= 0
+  if not kept.all():
+    print(f'Dropping {np.count_nonzero(~kept)} clicks from before the first '
+          f'session.')
+  # Merge every session's keystrokes and clicks in one sort, by session and
+  # then time.  It is stable, so clicks go after keystrokes at the same time.
+  num_keystrokes = [len(s.times) for s in window_sessions]
+  session_idxs = np.concatenate((
+    np.repeat(np.arange(len(window_sessions)), num_keystrokes),
+    session_idxs[kept]))
+  times = np.concatenate([s.times for s in window_sessions]
+                         + [click_times[kept]])
+  num_moves = np.concatenate([s.num_moves for s in window_sessions]
+                             + [click_moves[kept]])
+  order = np.lexsort((times, session_idxs))
+  split_points = np.cumsum(np.bincount(
+    session_idxs, minlength=len(window_sessions)))[:-1]
+  # Each session gets a view of the merged arrays.
+  for session, session_times, session_num_moves in zip(
+      window_sessions, np.split(times[order], split_points),
+      np.split(num_moves[order], split_points)):
+    session.times = session_times
+    session.num_moves = session_num_moves
+
+
+def _assign_clicks_one_at_a_time(window_sessions: List[WindowSession],
+                                 click_times: np.ndarray,
+                                 click_moves: np.ndarray):
+  """Like assign_clicks, but places each click the way get_window_sessions used
+  to, with a bisect and a sorted insert per click.  Only used to benchmark
+  assign_clicks against.
+  """
+  sessions = SortedList(window_sessions, key=WindowSession.get_start_key)
+  actions = [SortedList(zip(s.times.tolist(), s.num_moves.tolist()))
+             for s in sessions]
+  for click in zip(click_times.tolist(), click_moves.tolist()):
+    idx = sessions.bisect_key_left(click) - 1
+    if idx >= 0:
+      actions[idx].add(click)
+  for session, session_actions in zip(sessions, actions):
+    times, num_moves = zip(*session_actions)
+    session.times = np.array(times, dtype=np.int64)
+    session.num_moves = np.array(num_moves, dtype=np.int64)
+
+
 # This function attempts to group sessions assuming that they overlap, which
 # shouldn't normally happen
 def group_sessions(window_sessions, group_separation_time):
@@ -197,9 +513,8 @@ def group_sessions(window_sessions, group_separation_time):
   ]
   cur_session = window_sessions[0]
   for next_session in window_sessions[1:]:
-    cur_group_end = (cur_session.action_timings[-1].time
-             + group_separation_time)
-    if next_session.action_timings[0].time > cur_group_end:
+    cur_group_end = cur_session.get_end_time() + group_separation_time
+    if next_session.get_start_time() > cur_group_end:
       groups.append([])
     groups[-1].append(next_session)
     cur_session = next_session
@@ -207,69 +522,62 @@ def group_sessions(window_sessions, group_separation_time):
 
 
 def get_events_from_sessions(window_sessions, idle_time,
-               group_separation_time):
+               group_separation_time, active_since=None):
+  """Makes an event for each group of active sessions.
+
+  If active_since is given, active sessions starting before it are left out.
+  """
   # Split up long window sessions with inactive periods into several
   # sessions, each containing activity (clicks/keystrokes).
+  active_sessions = []
+  for window_session in window_sessions:
+    active_sessions += window_session.split_on_gaps(idle_time)
+  if active_since:
+    active_since_us = datetime_to_epoch_us(active_since)
+    active_sessions = [s for s in active_sessions
+                       if s.times[0] >= active_since_us]
+  if not active_sessions:
+    return []
 
   # Sessions can sometimes overlap (not sure why exactly...), so we enforce
   # that they are at least sorted by the first event that happens in each and
   # that the last event is the longest?
-  active_sessions = SortedList(key=lambda ws: ws.action_timings[0])
-  for window_session in window_sessions:
-    new_timings = utils.split_on_gaps(
-      window_session.action_timings, idle_time, key=lambda t: t.time)
-    for timings in new_timings:
-      active_sessions.add(
-        WindowSession(
-          title=window_session.title,
-          program_name=window_session.program_name,
-          action_timings=SortedList(timings, key=lambda t: t.time)))
-
-  # prev = None
-  # for s in active_sessions:
-  #   if prev and prev.action_timings[0].time > s.action_timings[0].time:
-  #     print(prev.title)
-  #     for t in prev.action_timings:
-  #       print(t)
-  #     print(s.title)
-  #     for t in s.action_timings:
-  #       print(t)
-  #     print()
-  #     raise Exception()
-  #   prev = s
-  # raise Exception('nope')
+  active_sessions.sort(key=WindowSession.get_start_key)
 
   # Group window sessions into chunks, where each chunk contains a continuous
   # period of activity, with no inactivity longer than idle_time.
   # grouped_sessions = group_sessions(active_sessions, group_separation_time)
-  grouped_sessions = utils.split_on_gaps(
-    active_sessions, group_separation_time,
-    key=lambda s: s.action_timings[0].time,
-    last_key=lambda s: s.action_timings[-1].time)
+  split_points = get_gap_split_points(
+    np.array([s.times[0] for s in active_sessions]),
+    np.array([s.times[-1] for s in active_sessions]),
+    group_separation_time)
+  grouped_sessions = [
+    active_sessions[start:end] for start, end in
+    zip([0, *split_points], [*split_points, len(active_sessions)])]
 
   return [make_cal_event_from_session_group(sessions)
       for sessions in grouped_sessions]
 
 
 def make_cal_event_from_session_group(sessions: List[WindowSession]):
-  if (sessions[0].action_timings[0].time
-      > sessions[-1].action_timings[-1].time):
+  if sessions[0].times[0] > sessions[-1].times[-1]:
     for s in sessions:
       print(s.title)
-      for t in s.action_timings:
-        print(t)
+      for t, num_moves in zip(s.times, s.num_moves):
+        print(epoch_us_to_datetime(t), num_moves)
     raise Exception()
+  totals = SessionGroupTotals.from_sessions(sessions)
   return calendar_api.CalendarEvent(
     start=dict(
-      dateTime=sessions[0].action_timings[0].time.replace(
+      dateTime=sessions[0].get_start_time().replace(
         tzinfo=tz.gettz('PST')).isoformat(),
       timeZone='America/Los_Angeles'),
     end=dict(
-      dateTime=sessions[-1].action_timings[-1].time.replace(
+      dateTime=sessions[-1].get_end_time().replace(
         tzinfo=tz.gettz('PST')).isoformat(),
       timeZone='America/Los_Angeles'),
-    summary=get_session_group_description(sessions, long=False),
-    description=get_session_group_description(sessions, long=True),
+    summary=get_session_group_description(totals, long=False),
+    description=get_session_group_description(totals, long=True),
   )
 
 
@@ -278,22 +586,174 @@ def get_selfspy_usage_events(
     session_limit=None,
     idle_seconds=60 * 3,
     event_separation_seconds=60 * 20,
+    watermark: Optional[Watermark] = None,
+    start_datetime: datetime = None,
+    end_datetime: datetime = None,
 ) -> List[calendar_api.CalendarEvent]:
+  """Makes calendar events from the activity in a selfspy database.
+
+  If a watermark is given, only events that are new or changed since it was
+  last updated are made, and it is then advanced past them.  The caller should
+  save it only once the events are safely written.
+
+  If start_datetime or end_datetime are given, only activity around them is
+  read, enough to make every event within them.  Events that straddle them
+  may be cut short, so should be filtered out (see calendar_api.filter_events).
+  """
   # db_name = 'test_selfspy_db/selfspy.sqlite'
   process = psutil.Process(os.getpid())
   print('mem used: ', process.memory_info().rss / 10**6, 'MB')
   print('db ', db_name)
-  window_sessions = get_window_sessions(db_name)
-  print('mem used: ', process.memory_info().rss / 10**6, 'MB')
-  if session_limit:
-    window_sessions = window_sessions[-session_limit:]
+  # Reading an event separation past the window shows where the groups of
+  # activity that straddle it start and end.
+  margin = 2 * timedelta(seconds=event_separation_seconds)
+  since = until = None
+  if start_datetime:
+    since = _to_local_time(start_datetime) - margin
+  if end_datetime:
+    until = _to_local_time(end_datetime) + margin
+  if watermark:
+    db = _connect(db_name)
+    keys_id, click_id = (
+        db.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+        for table in ('keys', 'click'))
+    db.close()
+    if keys_id < watermark.keys_id or click_id < watermark.click_id:
+      print('Selfspy database was replaced, processing all of it.')
+      watermark.__init__()
+    elif (keys_id, click_id) == (watermark.keys_id, watermark.click_id):
+      print('No new selfspy activity.')
+      return []
+    if watermark.trailing_group_start:
+      # The last group of activity can keep growing, so is made again.  Groups
+      # before it can't change.
+      since = max(since or datetime.min,
+                  datetime.fromisoformat(watermark.trailing_group_start))
+      print(f'Processing selfspy activity since {since}.')
+  window_sessions = get_window_sessions(
+      db_name, since=since, until=until, session_limit=session_limit)
   print('mem used: ', process.memory_info().rss / 10**6, 'MB')
   events = get_events_from_sessions(
     window_sessions, timedelta(seconds=idle_seconds),
-    timedelta(seconds=event_separation_seconds))
+    timedelta(seconds=event_separation_seconds), active_since=since)
   print('mem used: ', process.memory_info().rss / 10**6, 'MB')
+  if watermark:
+    watermark.keys_id = keys_id
+    watermark.click_id = click_id
+    if events:
+      last_event = events[-1]
+      # Skip the remade trailing event if it did not actually grow.
+      if (calendar_api.event_fingerprint(events[0]).hex()
+          == watermark.trailing_event_fingerprint):
+        events = events[1:]
+      watermark.trailing_group_start = _to_db_time(datetime.fromisoformat(
+          last_event['start']['dateTime']).replace(tzinfo=None))
+      watermark.trailing_event_fingerprint = calendar_api.event_fingerprint(
+          last_event).hex()
   return events
 
 
+def make_synthetic_db(db_name, num_keys_rows, seed=0):
+  """Writes a selfspy database of random activity, for benchmarking.
+
+  Only the tables and columns read here are created.
+  """
+  rng = random.Random(seed)
+  db = sqlite3.connect(db_name)
+  db.executescript("""
+      CREATE TABLE process (id INTEGER PRIMARY KEY, created_at DATETIME,
+                            name VARCHAR);
+      CREATE TABLE window (id INTEGER PRIMARY KEY, created_at DATETIME,
+                           title VARCHAR, process_id INTEGER);
+      CREATE TABLE keys (id INTEGER PRIMARY KEY, created_at DATETIME,
+                         timings BLOB, process_id INTEGER, window_id INTEGER);
+      CREATE TABLE click (id INTEGER PRIMARY KEY, created_at DATETIME,
+                          nrmoves INTEGER);
+      CREATE INDEX ix_keys_created_at ON keys (created_at);
+      CREATE INDEX ix_click_created_at ON click (created_at);""")
+  db.executemany('INSERT INTO process VALUES (?, NULL, ?)',
+                 [(i, f'program {i}') for i in range(10)])
+  db.executemany('INSERT INTO window VALUES (?, NULL, ?, ?)',
+                 [(i, f'Window {i}', i % 10) for i in range(200)])
+  t = datetime(2021, 1, 1, 9)
+  keys_rows = []
+  click_rows = []
+  for _ in range(num_keys_rows):
+    timings = [round(rng.expovariate(1 / 1.5), 3)
+               for _ in range(rng.randint(1, 40))]
+    started = t
+    t += timedelta(seconds=sum(timings))
+    window_id = rng.randrange(200)
+    keys_rows.append((
+        _to_db_time(t), zlib.compress(json.dumps(timings).encode()),
+        window_id % 10, window_id))
+    for _ in range(rng.randint(0, 4)):
+      click_rows.append(
+          (_to_db_time(started + timedelta(
+              seconds=rng.uniform(0, sum(timings) + 5))),
+           rng.randint(1, 50)))
+    t += timedelta(seconds=rng.choice([2, 30, 200, 2000, 20000]) * rng.random())
+  db.executemany('INSERT INTO keys (created_at, timings, process_id, '
+                 'window_id) VALUES (?, ?, ?, ?)', keys_rows)
+  db.executemany('INSERT INTO click (created_at, nrmoves) VALUES (?, ?)',
+                 sorted(click_rows))
+  db.commit()
+  db.close()
+
+
+def main():
+  argparser = argparse.ArgumentParser(
+      description='Print calendar events made from a selfspy database.')
+  argparser.add_argument('db_name', nargs='?', default='desktop_selfspy.sqlite')
+  argparser.add_argument(
+      '--benchmark_keys_rows', type=int, default=0,
+      help='Instead, write a synthetic database with this many Keys rows '
+           '(about 20 keystrokes and 2 clicks each) to a temporary directory, '
+           'and time reading it.  db_name is not used.')
+  argparser.add_argument(
+      '--num_workers', type=int, default=None,
+      help='Number of processes decoding Keys rows (default: one per cpu).')
+  args = argparser.parse_args()
+  if not args.benchmark_keys_rows:
+    pprint(get_selfspy_usage_events(args.db_name, None))
+    return
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    db_name = os.path.join(tmp_dir, 'synthetic_selfspy.sqlite')
+    make_synthetic_db(db_name, args.benchmark_keys_rows)
+    start = time.time()
+    window_sessions = get_window_sessions(
+        db_name, num_workers=args.num_workers)
+    read_secs = time.time() - start
+    num_actions = sum(len(s.times) for s in window_sessions)
+    print(f'Read {len(window_sessions)} sessions with {num_actions} actions '
+          f'in {read_secs:.2f}s ({num_actions / read_secs:.0f} actions/s).')
+
+    db = _connect(db_name)
+    click_times, click_moves = _read_clicks(
+        db, 'SELECT created_at, nrmoves FROM click ORDER BY id')
+    db.close()
+    for assign in (_assign_clicks_one_at_a_time, assign_clicks):
+      # Synthetic clicks always have mouse moves, so the keystrokes are the
+      # actions without any.
+      sessions = [
+          WindowSession(title=s.title, program_name=s.program_name,
+                        times=s.times[s.num_moves == 0],
+                        num_moves=s.num_moves[s.num_moves == 0])
+          for s in window_sessions]
+      start = time.time()
+      assign(sessions, click_times, click_moves)
+      print(f'{assign.__name__} placed {len(click_times)} clicks in '
+            f'{time.time() - start:.2f}s.')
+      assert all(np.array_equal(s.times, expected.times)
+                 and np.array_equal(s.num_moves, expected.num_moves)
+                 for s, expected in zip(sessions, window_sessions))
+
+  start = time.time()
+  events = get_events_from_sessions(
+      window_sessions, timedelta(minutes=3), timedelta(minutes=20))
+  print(f'Made {len(events)} events in {time.time() - start:.2f}s.')
+
+
 if __name__ == '__main__':
-  pprint(get_selfspy_usage_events('desktop_selfspy.sqlite', None))
+  main()
@@ -1,28 +1,6 @@
-import time
 from typing import Dict
 from datetime import datetime, timedelta
 from dateutil import tz
-import socket
-
-
-def retry_on_error(
-    function,
-    errors=(BrokenPipeError, ConnectionResetError, socket.timeout),
-    sleep_time_secs=3,
-    num_retries=5):
-  last_error = None
-  for retry in range(num_retries):
-    try:
-      return function()
-    except errors as e:
-      last_error = e
-      print(
-          f'Hit {e}, sleeping for {sleep_time_secs}s, then trying again.. '
-          f'(attempt {retry}/{num_retries})')
-      time.sleep(sleep_time_secs)
-    else:
-      break
-  raise last_error
 
 
 def timestamp_ms_to_event_time(